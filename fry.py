@@ -1,6 +1,20 @@
 #!/usr/bin/env python
 import unicodedata
 import string
+import re
+import os
+import io
+import mmap
+import struct
+import operator
+import bisect
+import contextlib
+import concurrent.futures
+import gc
+import collections
+import threading
+import asyncio
+import inspect
 
 # lex阶段生成的ast类型
 NONE              = 'none'
@@ -35,6 +49,7 @@ PYFUNCTION        = 'pyfunction'
 VARIABLE          = 'variable'
 LIST              = 'list'
 DICT              = 'dict'
+VALUES            = 'values'          # (values ...)返回的多个值
 
 # 各种特殊的CODE_LIST
 DO_LIST           = 'do-list'         # new scope
@@ -111,13 +126,6 @@ new_scope_creators = set([
         'finally',
         ])
 
-class AstVariable:
-    def __init__(self, name, ast, origin=False):
-        self.name = name
-        self.ast = ast
-        self.origin = origin
-
-
 class AstNode:
     def __init__(self, tag, value=None, suffix=None):
         self.tag = tag
@@ -128,6 +136,20 @@ class AstNode:
         self.next = None
         self.boundvars = None    # name set
         self.upvars = None       # name -> ast
+        self.special = None      # 特殊CODE_LIST的类型
+        self.slot = None         # hash函数体中$N参数的序号
+        self.fastcall = None     # hash函数能否不创建frame调用
+        self.nfixed = None       # 变参函数...之前的参数个数
+        self.head = None         # 点路径开头的标识符
+        self.path = None         # 点路径中预先切分、装箱的key
+        self.cache = None        # dict解构的缓存: (shape, offsets)
+        self.ics = None          # 点路径每一层record的inline cache: (shape, offset)
+        self.shape = None        # key都是:keyword的dict字面量的Shape
+        self.pos = None          # 在源代码中的位置
+        self.scope = None        # 标识符parse时解析到的绑定作用域
+        self.captured = False    # 作用域的变量是否被closure捕获
+        self.shadowing = False   # 作用域是否绑定了和外层作用域同名的变量
+        self.lazy = None         # 函数体延迟parse的fn: 函数体中外层变量名 -> 定义处解析到的作用域
 
     def append(self, value):
         if self.value:
@@ -220,10 +242,28 @@ class AstNode:
             raise RuntimeError(f"Not scope to add {name}")
         if scope.boundvars is None:
             scope.boundvars = set()
-        if not candup and name in scope.boundvars:
-            print(scope)
-            raise RuntimeError(f"Duplicate definition: {name}")
+        if name in scope.boundvars:
+            if not candup:
+                print(scope)
+                raise RuntimeError(f"Duplicate definition: {name}")
+            return
         scope.boundvars.add(name)
+        symtab = parsing.symtab
+        if symtab:
+            symtab.bind(scope, name)
+            form = symtab.form
+            if form is not None and form.parent is scope:
+                form.defines.add(name)
+                scope.definers[name] = form
+
+    def clearvars(self):
+        """清除本节点的绑定变量，返回清除前的变量集合"""
+        vars = self.boundvars
+        self.boundvars = None
+        symtab = parsing.symtab
+        if symtab and vars:
+            symtab.unbind(self, vars)
+        return vars
 
     def addvartoscope(self, name, candup=False):
         scope = self.getscope()
@@ -231,43 +271,6 @@ class AstNode:
             raise RuntimeError(f"No scope to add {name}")
         scope.addvar(name, candup)
 
-    def getvar(self, name):
-        """在本节点查找变量，包括绑定变量和捕获变量"""
-        if not self.isscope():
-            return None
-        if self.boundvars is None:
-            return None
-        if name in self.boundvars:
-            return AstVariable(name, self)
-        if not self.isfn():
-            return None
-        if self.upvars is None:
-            return None
-        if name in self.upvars:
-            return AstVariable(name, self, self.upvars[name])
-        return None
-
-    def queryvar(self, name=None):
-        """
-        在本节点及祖先节点查找变量，包括绑定变量和捕获变量。
-        如果是closure之外的变量，保存到closure捕获变量列表。
-        """
-        name = name if name else self.value
-        node = self
-        closures = []
-        while node:
-            var = node.getvar(name)
-            if var:
-                for closure in closures:
-                    if closure.upvars is None:
-                        closure.upvars = {}
-                    closure.upvars[name] = var.origin or var.ast
-                return var
-            if node.isfn():
-                closures.append(node)
-            node = node.parent
-        return None
-
     def __repr__(self):
         if self.tag in (NONE, TRUE, FALSE, VARARG):
             value = self.tag
@@ -311,6 +314,123 @@ class AstNode:
             return f"{value}"
 
 
+class SymbolTable:
+    """
+    parse阶段的符号表。
+    parse按树的顺序遍历，进入作用域时push，离开时pop，所以表中的作用域
+    都是当前节点的祖先。每个变量名对应一个按深度排序的作用域列表，
+    查找变量时直接取最内层的绑定，不需要沿着父节点逐层查找。
+    """
+    def __init__(self):
+        self.scopes = []   # 当前打开的作用域
+        self.fns = []      # 当前打开的fn/hashfn
+        self.names = {}    # map[name -> [scope]]
+        self.lazy = False  # fn函数体是否延迟到第一次调用时parse
+        self.form = None   # 正在parse的顶层form，记录它在最外层fn中绑定的名字
+        self.host = frozenset()  # 宿主提供的名字
+
+    def push(self, scope, bind=True):
+        scope.depth = len(self.scopes)
+        self.scopes.append(scope)
+        if scope.isfn():
+            self.fns.append(scope)
+        if bind and scope.boundvars:
+            for name in scope.boundvars:
+                self.bind(scope, name)
+
+    def pop(self, scope):
+        while self.scopes:
+            top = self.scopes.pop()
+            if self.fns and self.fns[-1] is top:
+                self.fns.pop()
+            if top.boundvars:
+                self.unbind(top, top.boundvars)
+            if top is scope:
+                break
+
+    def bind(self, scope, name):
+        scopes = self.names.get(name)
+        if scopes is None:
+            self.names[name] = [scope]
+        elif not scopes or scopes[-1].depth < scope.depth:
+            scopes.append(scope)
+        else:
+            # 绑定到外层作用域（如命名函数的函数名），按深度插入
+            i = len(scopes)
+            while i > 0 and scopes[i-1].depth > scope.depth:
+                i -= 1
+            scopes.insert(i, scope)
+        if scopes:
+            # 内层的同名绑定遮蔽外层
+            for inner in scopes[1:]:
+                inner.shadowing = True
+
+    def unbind(self, scope, names):
+        for name in names:
+            scopes = self.names.get(name)
+            if scopes:
+                if scopes[-1] is scope:
+                    scopes.pop()
+                elif scope in scopes:
+                    scopes.remove(scope)
+
+    def lookup(self, name):
+        """返回绑定name的最内层作用域"""
+        scopes = self.names.get(name)
+        return scopes[-1] if scopes else None
+
+    def query(self, name):
+        """
+        查找变量，并把变量保存到绑定作用域之内各个closure的捕获变量列表。
+        返回绑定变量的作用域。
+        """
+        scopes = self.names.get(name)
+        if not scopes:
+            return None
+        scope = scopes[-1]
+        fns = self.fns
+        i = len(fns) - 1
+        depth = scope.depth
+        if i >= 0 and fns[i].depth > depth:
+            scope.captured = True
+        while i >= 0 and fns[i].depth > depth:
+            fn = fns[i]
+            if fn.upvars is None:
+                fn.upvars = {}
+            elif fn.upvars.get(name) is scope:
+                # 内层closure已经捕获，外层closure也必然已经捕获
+                break
+            fn.upvars[name] = scope
+            i -= 1
+        return scope
+
+    @classmethod
+    def enter(cls, ast, names=None):
+        """
+        为从ast开始的parse创建符号表，打开ast之外的所有祖先作用域。
+        names是name -> 作用域时，祖先作用域只绑定names中的名字。
+        """
+        table = cls()
+        scopes = []
+        node = ast.getscope()
+        while node:
+            scopes.append(node)
+            node = node.getscope()
+        for scope in reversed(scopes):
+            table.push(scope, names is None)
+        if names:
+            for name, scope in names.items():
+                table.names[name] = [scope]
+        return table
+
+
+class ParseState(threading.local):
+    """每个线程各自的parse状态，多个线程可以同时parse"""
+    symtab = None  # 当前parse使用的符号表
+
+parsing = ParseState()
+
+
 next_frame_id = 1
 
 class Frame:
@@ -356,6 +476,51 @@ class Value:
         return f'Value({self.tag}, {self.value})'
 
 
+class Keyword(str):
+    """
+    :keyword。fry的标量直接使用Python的int/float/str/bool/None，
+    keyword是intern过的str，和同内容的字符串相等，dict查找时直接命中同一个对象。
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        # 在其他进程中反序列化时也intern
+        return intern_string, (str(self),)
+
+
+# 标量的Python类型对应的tag
+native_tags = {int: INTEGER, float: FLOAT, str: STRING, Keyword: STRING, type(None): NONE}
+
+def tagof(value):
+    """标量按Python类型得到tag，其他Value用自己的tag"""
+    tag = native_tags.get(value.__class__)
+    if tag is not None:
+        return tag
+    if value.__class__ is bool:
+        return TRUE if value else FALSE
+    return value.tag
+
+def equal(a, b):
+    """fry的相等：类型不同就不相等，1、1.0和true互不相等；list/dict逐个元素按fry的相等比较"""
+    cls = a.__class__
+    if cls is not b.__class__ and tagof(a) != tagof(b):
+        return False
+    if cls is List:
+        a, b = a.value, b.value
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, Dict):
+        # key已经由dict_key区分了类型，直接按Python的相等查找
+        a, b = a.value, b.value
+        if len(a) != len(b):
+            return False
+        for key, value in a.items():
+            other = b.get(key, missing)
+            if other is missing or not equal(value, other):
+                return False
+        return True
+    return a == b
+
+
 class UpValue(Value):
     def __init__(self, frame, name):
         super().__init__(UPVALUE)
@@ -371,14 +536,16 @@ class Closure(Value):
         """
         super().__init__(CLOSURE, fn)
         self.upvalues = {} # map[name -> frameid]
+        self.frame = None  # hash函数调用共享的frame
 
 
 class PyFunction(Value):
-    def __init__(self, pf):
+    def __init__(self, pf, compiled=False):
         """
-        pf是Python函数
+        pf是Python函数，compiled为True时是transpile生成的fry函数
         """
         super().__init__(PYFUNCTION, pf)
+        self.compiled = compiled
 
 
 class Variable(Value):
@@ -394,6 +561,17 @@ class Variable(Value):
         self.vdict[self.vname] = value
 
 
+class Values(Value):
+    def __init__(self, values):
+        """
+        values是Python的list或tuple，多个值直接传递给绑定或者函数参数，不生成List
+        """
+        super().__init__(VALUES, values)
+
+    def __bool__(self):
+        return bool(self.value) and bool(self.value[0])
+
+
 class List(Value):
     def __init__(self, value=None):
         value = value if value else []
@@ -408,11 +586,192 @@ class List(Value):
 
 class Dict(Value):
     def __init__(self, value=None):
+        """value的key要经过dict_key转换"""
         value = value if value else {}
         super().__init__(DICT, value)
 
     def get(self, key):
-        return self.value[key]
+        return self.value[dict_key(key)]
+
+
+class TaggedKey:
+    """
+    Python中1、1.0和True的hash和相等都相同，作为dict的key会互相覆盖，fry中它们互不相等。
+    bool和整数值的float作为Dict的key时包装为TaggedKey，按(类型, 值)区分；
+    int、str和其他float直接作为key，常见的key不需要包装
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return hash((self.value.__class__, self.value))
+
+    def __eq__(self, other):
+        return (other.__class__ is TaggedKey and
+                other.value.__class__ is self.value.__class__ and other.value == self.value)
+
+    def __reduce__(self):
+        return TaggedKey, (self.value,)
+
+    def __repr__(self):
+        return repr(self.value)
+
+def dict_key(key):
+    """fry的值 -> Dict中的key"""
+    cls = key.__class__
+    if cls is bool or (cls is float and key.is_integer()):
+        return TaggedKey(key)
+    return key
+
+def plain_key(key):
+    """Dict中的key -> fry的值"""
+    return key.value if key.__class__ is TaggedKey else key
+
+
+class Shape:
+    """
+    key都是:keyword的dict(record)的布局。key序列相同的record共享一个Shape，
+    值按offset存在数组里。
+    """
+    shapes = {}
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.offsets = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def of(cls, keys):
+        keys = tuple(keys)
+        shape = cls.shapes.get(keys)
+        if shape is None:
+            shape = cls.shapes[keys] = cls(keys)
+        return shape
+
+    def __reduce__(self):
+        # 在其他进程中反序列化时也共享同一个Shape
+        return Shape.of, (self.keys,)
+
+
+class Record(Dict):
+    def __init__(self, shape, slots):
+        """
+        shape是key的布局，slots是按offset存放的值。
+        record创建后不再修改，需要Python dict时才生成一次。
+        """
+        self.tag = DICT
+        self.shape = shape
+        self.slots = slots
+        self.dict = None
+
+    @property
+    def value(self):
+        if self.dict is None:
+            self.dict = dict(zip(self.shape.keys, self.slots))
+        return self.dict
+
+    def get(self, key):
+        return self.slots[self.shape.offsets[key]]
+
+
+def display(value, quote=False):
+    """print使用的显示格式，容器中的字符串加引号"""
+    tag = tagof(value)
+    if tag in (NONE, TRUE, FALSE):
+        return tag
+    elif tag == STRING:
+        return f'"{value}"' if quote else str(value)
+    elif tag in (INTEGER, FLOAT):
+        return str(value)
+    elif tag == LIST:
+        return '[' + ' '.join(display(v, True) for v in value.value) + ']'
+    elif tag == DICT:
+        items = ' '.join(f'{display(plain_key(k), True)}: {display(v, True)},' for k, v in value.value.items())
+        return '{' + items + '}'
+    elif tag == CLOSURE:
+        fn = value.value
+        if fn.tag == CODE_LIST and fn.value[1].tag == IDENTIFIER:
+            return f'<fn {fn.value[1].value}>'
+        return '<fn>'
+    elif tag == PYFUNCTION:
+        return '<pyfunction>'
+    return repr(value)
+
+# :foo符号和点路径中的key共用同一个Keyword对象
+interned = {}
+
+def intern_string(s):
+    value = interned.get(s)
+    if value is None:
+        value = interned[s] = Keyword(s)
+    return value
+
+def path_key(ast):
+    """点路径中的常量key：数字是list下标，其他是dict的key"""
+    if ast.tag == INTEGER:
+        return ast.value
+    if ast.tag == IDENTIFIER and ast.value.isdigit():
+        return int(ast.value)
+    return intern_string(ast.value)
+
+# 可以作为跳转表key的常量
+const_tags = set([NONE, TRUE, FALSE, INTEGER, FLOAT,
+                  SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING, STRING])
+
+# 值就是ast.value的节点
+value_tags = set([INTEGER, FLOAT, SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING])
+
+# 没有子节点要求值的节点，生成器中直接求值，不交给execute
+leaf_tags = set([NONE, TRUE, FALSE, INTEGER, FLOAT, SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING,
+                 INTERN_STRING, IDENTIFIER, MULTI_IDENTIFIER, VARARG])
+
+# elif链至少有这么多分支时才生成跳转表
+jumptable_min = 4
+
+def frange(begin, end, step):
+    """浮点数的range"""
+    n = begin
+    while n < end if step > 0 else n > end:
+        yield n
+        n += step
+
+def for_range(begin, end, step=1):
+    """for循环的范围，都是整数时是range，否则是frange"""
+    for bound in (begin, end, step):
+        if bound.__class__ is not int and bound.__class__ is not float:
+            raise RuntimeError(f"Invalid for range {display(bound, True)}")
+    if step == 0:
+        raise RuntimeError("for step can not be 0")
+    if begin.__class__ is int and end.__class__ is int and step.__class__ is int:
+        return range(begin, end, step)
+    return frange(begin, end, step)
+
+def each_items(seq, n):
+    """
+    each循环迭代的内容，直接迭代原容器，不复制。
+    list按元素迭代（n为2时是序号和元素），dict按key迭代（n为2时是key和value）。
+    """
+    cls = seq.__class__
+    if cls is List:
+        return enumerate(seq.value) if n == 2 else seq.value
+    elif cls is Record:
+        return zip(seq.shape.keys, seq.slots) if n == 2 else seq.shape.keys
+    elif cls is Dict:
+        if n == 2:
+            return ((k.value if k.__class__ is TaggedKey else k, v) for k, v in seq.value.items())
+        return (k.value if k.__class__ is TaggedKey else k for k in seq.value)
+    elif isinstance(seq, str):
+        return enumerate(seq) if n == 2 else seq
+    raise RuntimeError(f"Can not iterate {display(seq, True)}")
+
+
+class BreakLoop(Exception):
+    """(break)跳出最内层循环"""
+
+
+class ContinueLoop(Exception):
+    """(continue)进入最内层循环的下一次迭代"""
 
 
 # ascii字符的printable字符（string.printable)共有100个字符，包括：
@@ -456,9 +815,69 @@ def is_identifier(ch):
 def is_multi_identifier(ch):
     return is_intern(ch) and ch not in  '&@#'
 
+# ascii字符的快速扫描：连续的ascii标识符字符一次性切片，不逐个字符判断
+def ascii_run(pred, binary=False):
+    chars = ''.join(chr(n) for n in range(128) if pred(chr(n)))
+    pattern = '[' + ''.join(f'\\x{ord(c):02x}' for c in chars) + ']+'
+    return re.compile(pattern.encode('ascii') if binary else pattern)
+
+ascii_runs = {
+    binary: {
+        is_intern: ascii_run(is_intern, binary),
+        is_identifier: ascii_run(is_identifier, binary),
+        is_multi_identifier: ascii_run(is_multi_identifier, binary),
+    } for binary in (False, True)
+}
+
+# 字符串中无需特殊处理的字符（引号、转义符和换行符之外）可以一次性切片
+def string_run(quote, binary=False):
+    pattern = f'[^{quote}\\\\\\n]+'
+    return re.compile(pattern.encode('ascii') if binary else pattern)
+
+string_runs = {
+    binary: {quote: string_run(quote, binary) for quote in '\'"'}
+    for binary in (False, True)
+}
+
+# 连续的非ascii字符一次性解码，再逐个字符判断，字节输入不用每个字符单独解码
+nonascii_runs = {
+    False: re.compile('[^\x00-\x7f]+'),
+    True: re.compile(b'[\x80-\xff]+'),
+}
+
+# 非ascii字符是否满足谓词的缓存：pred -> map[字符 -> bool]，大文件中的非ascii字符通常只有几千个
+nonascii_checked = {pred: {} for pred in (is_intern, is_identifier, is_multi_identifier)}
+
+ascii_chars = [chr(n) for n in range(128)]
+
+def utf8_width(b):
+    """utf-8首字节对应的字符字节数"""
+    if b < 0xe0:
+        return 2
+    elif b < 0xf0:
+        return 3
+    return 4
+
+def tonumber(s):
+    try:
+        return 'int', int(s, 0)
+    except ValueError:
+        try:
+            return 'float', float(s)
+        except ValueError:
+            return 'nan', 0
+
 def lex(code):
+    """
+    code可以是str，也可以是utf-8编码的bytes/bytearray/mmap。
+    字节输入不会整体解码，只有非ascii字符和字符串/标识符片段才解码。
+    """
     i = 0
-    prefetch = []
+    binary = not isinstance(code, str)
+    size = len(code)
+    eol = b'\n' if binary else '\n'
+    runs = ascii_runs[binary]
+    nonascii = nonascii_runs[binary]
     root = AstNode(CODE_LIST, [])
     rootfn = AstNode(CODE_LIST, [])
     root.append(rootfn)
@@ -468,60 +887,76 @@ def lex(code):
 
     def getc():
         nonlocal i
-        if prefetch:
-            return prefetch.pop()
-        elif i < len(code):
+        if i < size:
             ch = code[i]
-            i += 1
+            if not binary:
+                i += 1
+            elif ch < 0x80:
+                ch = ascii_chars[ch]
+                i += 1
+            else:
+                n = utf8_width(ch)
+                ch = code[i:i+n].decode('utf-8')
+                i += n
             return ch
 
     def ungetc(ch):
-        prefetch.append(ch)
+        # 只会回退刚读出的字符，直接回退读位置即可
+        nonlocal i
+        i -= 1 if ch < '\x80' or not binary else len(ch.encode('utf-8'))
 
-    def get_intern():
+    def text(begin, end):
+        return code[begin:end].decode('utf-8') if binary else code[begin:end]
+
+    def get_chars(pred):
+        nonlocal i
+        run = runs[pred]
+        checked = nonascii_checked[pred]
         chars = []
-        ch = getc()
-        while ch:
-            if is_intern(ch):
-                chars.append(ch)
-                ch = getc()
-            else:
-                ungetc(ch)
+        while True:
+            m = run.match(code, i)
+            if m:
+                chars.append(text(i, m.end()))
+                i = m.end()
+            m = nonascii.match(code, i)
+            if not m:
                 break
+            s = text(i, m.end())
+            for n, ch in enumerate(s):
+                ok = checked.get(ch)
+                if ok is None:
+                    ok = checked[ch] = pred(ch)
+                if not ok:
+                    s = s[:n]
+                    break
+            else:
+                chars.append(s)
+                i = m.end()
+                continue
+            chars.append(s)
+            i += len(s.encode('utf-8')) if binary else len(s)
+            break
         return ''.join(chars)
 
+    def get_intern():
+        return get_chars(is_intern)
+
     def get_identifier():
-        chars = []
-        ch = getc()
-        while ch:
-            if is_identifier(ch):
-                chars.append(ch)
-                ch = getc()
-            else:
-                ungetc(ch)
-                break
-        return ''.join(chars)
+        return get_chars(is_identifier)
 
     def get_multi_identifier():
-        chars = []
-        ch = getc()
-        while ch:
-            if is_multi_identifier(ch):
-                chars.append(ch)
-                ch = getc()
-            else:
-                ungetc(ch)
-                break
-        return ''.join(chars)
+        return get_chars(is_multi_identifier)
 
-    def tonumber(s):
-        try:
-            return 'int', int(s, 0)
-        except ValueError:
-            try:
-                return 'float', float(s)
-            except ValueError:
-                return 'nan', 0
+    def get_line():
+        """读到行尾（包括换行符），返回读到的内容以及是否遇到换行符"""
+        nonlocal i
+        begin = i
+        end = code.find(eol, i)
+        if end < 0:
+            i = size
+            return text(begin, size), False
+        i = end + 1
+        return text(begin, i), True
 
     def error(msg):
         print(root)
@@ -532,6 +967,8 @@ def lex(code):
 
     def finish_node(node):
         nonlocal hassuffix
+        if node.pos is None:
+            node.pos = i
         ch = getc()
         suffix = None
         # ':'和','后可以不用带空白字符
@@ -570,6 +1007,7 @@ def lex(code):
         if t == HASH_LIST and stack[-1].tag == HASH_LIST:
             error("Hashfn does not support hashfn")
         node = AstNode(t, [])
+        node.pos = i
         stack.append(node)
         return node
 
@@ -640,38 +1078,31 @@ def lex(code):
         if ch == '\n':
             hasspace = True
         elif ch == ';':
-            ch = getc()
-            while ch:
-                if ch == '\n':
-                    hasspace = True
-                    break
-                ch = getc()
+            _, hasspace = get_line()
         elif ch == '`':
-            chars = []
-            ch = getc()
-            while ch:
-                chars.append(ch)
-                if ch == '\n':
-                    hasspace = True
-                    break
-                ch = getc()
-            chars = ''.join(chars)
+            chars, hasspace = get_line()
             if chars:
                 backstr.append(chars)
         elif ch == "'" or ch == '"':
             begin = ch
             chars = []
             stype = SINGLE_STRING if ch == "'" else DOUBLE_STRING
-            ch = getc()
-            while ch:
-                if ch == '\\':
-                    ch = getc()
-                    if ch:
-                        if ch == '\n':
-                            error("string is not closed in the same line")
-                        chars.append(ch)
-                    else: break
+            run = string_runs[binary][begin]
+            while True:
+                m = run.match(code, i)
+                if m:
+                    chars.append(text(i, m.end()))
+                    i = m.end()
+                ch = getc()
+                if not ch:
+                    error("string is not closed")
+                elif ch == '\\':
                     ch = getc()
+                    if not ch:
+                        error("string is not closed")
+                    elif ch == '\n':
+                        error("string is not closed in the same line")
+                    chars.append(ch)
                 elif ch == '\n':
                     error("string is not closed in the same line")
                 elif ch == begin:
@@ -680,8 +1111,6 @@ def lex(code):
                     break
                 else:
                     chars.append(ch)
-                    ch = getc()
-            else: error("string is not closed")
         elif ch == ':':
             s = get_intern()
             if not s:
@@ -757,6 +1186,510 @@ def lex(code):
     return root
 
 
+def lexfile(path, workers=1):
+    """
+    通过mmap把文件映射到内存后直接在字节上lex，避免整个文件解码为str。
+    workers不为1时大文件用lex_parallel分段并行lex，None表示使用所有cpu
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return lex('')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if workers != 1:
+                return lex_parallel(buf, workers, path)
+            return lex(buf)
+
+
+# 小于这个大小(字符数或字节数)的输入不值得启动进程池，直接lex
+parallel_lex_min = 1 << 20
+
+# 查找顶层form边界只需要括号和换行，字符串、注释和反引号行整体跳过，
+# 其中的括号不计入深度
+form_token = r'''
+    (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<newline>\n)
+  | (?P<backtick>`[^\n]*)
+  | (?P<hash>\#)
+  | '[^'\\\n]*(?:\\.[^'\\\n]*)*'
+  | "[^"\\\n]*(?:\\.[^"\\\n]*)*"
+  | ;[^\n]*
+'''
+
+form_tokens = {
+    binary: re.compile(form_token.encode('ascii') if binary else form_token, re.X)
+    for binary in (False, True)
+}
+
+
+def form_boundaries(code):
+    """
+    生成code中顶层form之间的行首位置，最后生成len(code)表示结尾处列表都已闭合。
+    以下位置不是边界：
+    1. 反引号行之后，连续的反引号行要在同一段中合并为一个字符串
+    2. 顶层的#之后直到下一个顶层列表开始前，#的元素可能在后面的行中
+    括号不配对时停止生成，由lex报告错误
+    """
+    depth = 0
+    backtick = False
+    hashed = False
+    for m in form_tokens[not isinstance(code, str)].finditer(code):
+        kind = m.lastgroup
+        if kind == 'newline':
+            if depth == 0 and not backtick and not hashed:
+                yield m.end()
+            backtick = False
+        elif kind == 'open':
+            if depth == 0:
+                hashed = False
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+            if depth < 0:
+                return
+        elif depth == 0:
+            if kind == 'backtick':
+                backtick = True
+            elif kind == 'hash':
+                hashed = True
+    if depth == 0 and not hashed:
+        yield len(code)
+
+
+def split_forms(code, n):
+    """把code在顶层form边界切成大约n段，返回切分位置的列表(包括0和len(code))"""
+    size = len(code)
+    step = max(size // n, 1)
+    cuts = [0]
+    for end in form_boundaries(code):
+        if cuts[-1] + step <= end < size:
+            cuts.append(end)
+    cuts.append(size)
+    return cuts
+
+
+def pack_node(ast, offset):
+    """lex结果的紧凑表示，只有lex设置的属性，用于在进程间传递"""
+    value = ast.value
+    if isinstance(value, list):
+        value = [pack_node(item, offset) for item in value]
+    pos = ast.pos if ast.pos is None else ast.pos + offset
+    return ast.tag, value, ast.suffix, pos
+
+
+def unpack_node(packed):
+    tag, value, suffix, pos = packed
+    node = AstNode(tag, value, suffix)
+    node.pos = pos
+    if isinstance(value, list):
+        prev = None
+        for i, item in enumerate(value):
+            child = value[i] = unpack_node(item)
+            child.parent = node
+            child.prev = prev
+            if prev is not None:
+                prev.next = child
+            prev = child
+    return node
+
+
+def lex_chunk(code, begin, end, path=None):
+    """
+    在子进程中lex源代码[begin, end)这一段，返回其中顶层节点的紧凑表示，pos为在整个源代码中的位置。
+    path不为None时从文件中读取这一段，避免把源代码传给子进程。有词法错误时返回None
+    """
+    if path is not None:
+        with open(path, 'rb') as f:
+            f.seek(begin)
+            code = f.read(end - begin)
+    try:
+        # lex出错时会打印已lex的部分，这里只是一段，不打印
+        with contextlib.redirect_stdout(io.StringIO()):
+            rootfn = lex(code).value[0]
+    except RuntimeError:
+        return None
+    return [pack_node(ast, begin) for ast in rootfn.value[2:]]
+
+
+def lex_parallel(code, workers=None, path=None):
+    """
+    在顶层form边界把大的源代码切分成多段，在进程池中分别lex后拼接到同一个rootfn下，
+    结果和lex(code)相同。
+    workers为None时使用所有cpu；code来自文件时传入path，子进程直接从文件读取各段。
+    有词法错误时退回lex(code)，由lex报告错误
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or len(code) < parallel_lex_min:
+        return lex(code)
+    cuts = split_forms(code, workers * 4)
+    if len(cuts) < 3:
+        return lex(code)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(lex_chunk, None if path else code[begin:end], begin, end, path)
+                for begin, end in zip(cuts, cuts[1:])]
+        chunks = [job.result() for job in jobs]
+    if None in chunks:
+        return lex(code)
+    root = lex('')
+    rootfn = root.value[0]
+    # 拼接时创建大量节点，都不是垃圾，暂停循环垃圾回收
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for chunk in chunks:
+            for packed in chunk:
+                rootfn.append(unpack_node(packed))
+    finally:
+        if enabled:
+            gc.enable()
+    return root
+
+
+# 纯数据字面量的词法单元
+data_token = re.compile(r'''
+    (?:[\s,]+|;[^\n]*)*
+    (?:
+    (?P<begin>[\[{])
+  | (?P<end>[\]}])
+  | (?P<string>'(?:[^'\\\n]|\\[^\n])*'|"(?:[^"\\\n]|\\[^\n])*")(?P<stringkey>:?)
+  | (?P<backtick>`[^\n]*(?:\n|\Z)(?:[^\S\n]*`[^\n]*(?:\n|\Z))*)
+  | :(?P<intern>[^\s:;,'"`()\[\]{}]+)(?P<internkey>:?)
+  | (?P<word>[^\s:;,'"`()\[\]{}]+)(?P<wordkey>:?)
+  | (?P<eof>\Z)
+    )
+''', re.X)
+
+escaped_char = re.compile(r'\\(.)')
+backtick_line = re.compile(r'[^\S\n]*`([^\n]*(?:\n|\Z))')
+identifier_run = ascii_runs[False][is_identifier]
+# 只有这些字符开头或者是这些单词时，才可能是数字
+numeric_first = set('0123456789+-.')
+float_words = set(['inf', 'infinity', 'nan'])
+
+def loads(code, native=True):
+    """
+    快速加载只包含数据字面量(list/dict/字符串/数字/true/false/none)的fry代码，
+    类似json.loads。不经过lex/parse/eval，没有作用域分析。
+    标量总是Python原生的str/int/float/bool/None，
+    native为True时容器是Python的dict/list，否则是Fry的Dict/List。
+    """
+    if not isinstance(code, str):
+        code = bytes(code).decode('utf-8')
+    mklist, mkdict = (list, dict) if native else (List, Dict)
+    consts = {'true': True, 'false': False, 'none': None}
+
+    def error(msg):
+        raise RuntimeError(f"{msg} at {pos}")
+
+    # stack元素: [容器, 是否dict, 待赋值的dict key]
+    nokey = object()
+    stack = []
+    result = []
+    pos = 0
+    size = len(code)
+    while pos < size:
+        m = data_token.match(code, pos)
+        if not m:
+            error(f"Invalid data character {code[pos]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == 'eof':
+            break
+        elif kind == 'begin':
+            isdict = m.group('begin') == '{'
+            stack.append([{} if isdict else [], isdict, nokey])
+            continue
+        elif kind == 'end':
+            if not stack or stack[-1][1] != (m.group('end') == '}'):
+                error("unpaired ]/}")
+            items, isdict, key = stack.pop()
+            if key is not nokey:
+                error(f"No value for dict key {key}")
+            value = mkdict(items) if isdict else mklist(items)
+            iskey = False
+        elif kind == 'stringkey' or kind == 'string':
+            value = m.group('string')[1:-1]
+            if '\\' in value:
+                value = escaped_char.sub(r'\1', value)
+            iskey = bool(m.group('stringkey'))
+        elif kind == 'backtick':
+            value = ''.join(backtick_line.findall(m.group('backtick')))
+            iskey = False
+        elif kind == 'intern' or kind == 'internkey':
+            value = m.group('intern')
+            iskey = bool(m.group('internkey'))
+        else:
+            word = m.group('word')
+            iskey = bool(m.group('wordkey'))
+            if word[0] in numeric_first or word.lower() in float_words:
+                nt, n = tonumber(word)
+            else:
+                nt = 'nan'
+            if nt == 'int' or nt == 'float':
+                value = n
+            elif word in consts:
+                value = consts[word]
+            elif iskey and stack and stack[-1][1] and (
+                    identifier_run.fullmatch(word) or all(is_identifier(ch) for ch in word)):
+                # dict中的标识符key是intern字符串
+                value = word
+            else:
+                error(f"Not a data literal: {word}")
+
+        if not stack:
+            if iskey:
+                error("Invalid suffix ':'")
+            result.append(value)
+        elif not stack[-1][1]:
+            if iskey:
+                error("Invalid list item suffix ':'")
+            stack[-1][0].append(value)
+        elif stack[-1][2] is nokey:
+            if not iskey:
+                error(f"Invalid dict key {value}")
+            stack[-1][2] = value if native else dict_key(value)
+        else:
+            if iskey:
+                error(f"Invalid dict value {value}")
+            stack[-1][0][stack[-1][2]] = value
+            stack[-1][2] = nokey
+    if stack:
+        error("unclosed [/{")
+    if len(result) != 1:
+        error(f"Expect one data literal, got {len(result)}")
+    return result[0]
+
+
+def loadfile(path, native=True):
+    with open(path, encoding='utf-8') as f:
+        return loads(f.read(), native)
+
+
+# 二进制序列化格式中的类型标记
+SER_NONE          = 0
+SER_TRUE          = 1
+SER_FALSE         = 2
+SER_INTEGER       = 3   # zigzag varint
+SER_FLOAT         = 4   # 8字节double
+SER_STRING        = 5   # varint长度 + utf-8，加入字符串表
+SER_STRING_REF    = 6   # 字符串表序号
+SER_LIST          = 7   # varint长度 + 各元素
+SER_DICT          = 8   # varint长度 + 各key/value
+SER_REF           = 9   # 已出现过的List/Dict序号
+
+SER_MAGIC = b'FRY\x01'
+
+float_struct = struct.Struct('<d')
+
+
+class Encoder:
+    """
+    把fry值(标量和List/Dict，或者Python原生值)编码为紧凑的二进制格式写入stream。
+    字符串(包括:keyword)只在第一次出现时写入内容，之后只写字符串表序号；
+    同一个List/Dict对象再次出现时只写引用序号。
+    一个Encoder可以连续写入多个值，字符串表和引用表在整个流中共享。
+    """
+    def __init__(self, stream, bufsize=65536):
+        self.stream = stream
+        self.bufsize = bufsize
+        self.buf = bytearray(SER_MAGIC)
+        self.strings = {}  # map[str -> index]
+        self.refs = {}     # map[id -> index]
+        self.objects = []  # 保证引用表中的对象存活，id不会被复用
+
+    def write_uint(self, n):
+        buf = self.buf
+        while n > 0x7f:
+            buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    def write_string(self, s):
+        index = self.strings.get(s)
+        if index is not None:
+            self.buf.append(SER_STRING_REF)
+            self.write_uint(index)
+        else:
+            self.strings[s] = len(self.strings)
+            data = s.encode('utf-8')
+            self.buf.append(SER_STRING)
+            self.write_uint(len(data))
+            self.buf += data
+
+    def write_container(self, obj, items, isdict):
+        index = self.refs.get(id(obj))
+        if index is not None:
+            self.buf.append(SER_REF)
+            self.write_uint(index)
+            return
+        self.refs[id(obj)] = len(self.objects)
+        self.objects.append(obj)
+        self.buf.append(SER_DICT if isdict else SER_LIST)
+        self.write_uint(len(items))
+        if isdict:
+            for k, v in items.items():
+                self.write(plain_key(k))
+                self.write(v)
+        else:
+            for item in items:
+                self.write(item)
+
+    def write(self, value):
+        if isinstance(value, Value):
+            tag = value.tag
+            if tag == LIST:
+                return self.write_container(value, value.value, False)
+            elif tag == DICT:
+                return self.write_container(value, value.value, True)
+            else:
+                raise RuntimeError(f"Cannot serialize {value}")
+        if value is None:
+            self.buf.append(SER_NONE)
+        elif value is True:
+            self.buf.append(SER_TRUE)
+        elif value is False:
+            self.buf.append(SER_FALSE)
+        elif isinstance(value, int):
+            self.buf.append(SER_INTEGER)
+            self.write_uint(value << 1 if value >= 0 else (-value << 1) - 1)
+        elif isinstance(value, float):
+            self.buf.append(SER_FLOAT)
+            self.buf += float_struct.pack(value)
+        elif isinstance(value, str):
+            self.write_string(value)
+        elif isinstance(value, list):
+            self.write_container(value, value, False)
+        elif isinstance(value, dict):
+            self.write_container(value, value, True)
+        else:
+            raise RuntimeError(f"Cannot serialize {value!r}")
+        if len(self.buf) >= self.bufsize:
+            self.flush()
+
+    def encode(self, value):
+        self.write(value)
+        self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.stream.write(self.buf)
+            self.buf = bytearray()
+
+
+class Decoder:
+    """
+    从stream中逐个读取Encoder写入的值。
+    native为True时返回Python原生值，否则容器是Fry的List/Dict。
+    """
+    def __init__(self, stream, native=False, bufsize=65536):
+        self.stream = stream
+        self.native = native
+        self.bufsize = bufsize
+        self.buf = b''
+        self.pos = 0
+        self.strings = []
+        self.refs = []
+        self.started = False
+        self.consts = [None, True, False]
+
+    def fill(self, n):
+        """保证缓冲区中至少有n个未读字节，返回是否成功"""
+        while len(self.buf) - self.pos < n:
+            data = self.stream.read(max(self.bufsize, n))
+            if not data:
+                return False
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        return True
+
+    def read(self, n):
+        if not self.fill(n):
+            raise RuntimeError("Truncated fry binary data")
+        data = self.buf[self.pos:self.pos+n]
+        self.pos += n
+        return data
+
+    def read_byte(self):
+        if self.pos >= len(self.buf) and not self.fill(1):
+            raise RuntimeError("Truncated fry binary data")
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def read_uint(self):
+        n = shift = 0
+        while True:
+            b = self.read_byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def read_value(self):
+        t = self.read_byte()
+        if t <= SER_FALSE:
+            return self.consts[t]
+        native = self.native
+        if t == SER_INTEGER:
+            n = self.read_uint()
+            n = n >> 1 if not n & 1 else -((n + 1) >> 1)
+            return n
+        elif t == SER_FLOAT:
+            return float_struct.unpack(self.read(8))[0]
+        elif t == SER_STRING:
+            s = bytes(self.read(self.read_uint())).decode('utf-8')
+            self.strings.append(s)
+            return s
+        elif t == SER_STRING_REF:
+            return self.strings[self.read_uint()]
+        elif t == SER_LIST:
+            n = self.read_uint()
+            value = [] if native else List()
+            items = value if native else value.value
+            self.refs.append(value)
+            for _ in range(n):
+                items.append(self.read_value())
+            return value
+        elif t == SER_DICT:
+            n = self.read_uint()
+            value = {} if native else Dict()
+            items = value if native else value.value
+            self.refs.append(value)
+            for _ in range(n):
+                k = self.read_value()
+                items[k if native else dict_key(k)] = self.read_value()
+            return value
+        elif t == SER_REF:
+            return self.refs[self.read_uint()]
+        raise RuntimeError(f"Invalid fry binary tag {t}")
+
+    def decode(self):
+        """读取下一个值，流结束时抛出EOFError"""
+        if not self.started:
+            if not self.fill(len(SER_MAGIC)) or self.read(len(SER_MAGIC)) != SER_MAGIC:
+                raise RuntimeError("Not fry binary data")
+            self.started = True
+        if not self.fill(1):
+            raise EOFError
+        return self.read_value()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.decode()
+            except EOFError:
+                return
+
+
+def serialize(value):
+    stream = io.BytesIO()
+    Encoder(stream).encode(value)
+    return stream.getvalue()
+
+def deserialize(data, native=False):
+    return Decoder(io.BytesIO(data), native).decode()
+
+
 builtins = set([
     '.',
     '..',
@@ -779,6 +1712,9 @@ builtins = set([
     'filter',
     'len',
     'print',
+    'values',
+    'pmap',
+    'peach',
 ])
 
 
@@ -795,57 +1731,340 @@ def mkcond(items):
     return cond
 
 
-def parse(ast):
-    if ast.tag in (NONE, TRUE, FALSE):
-        pass
-    elif ast.tag in (INTEGER, FLOAT):
-        pass
-    elif ast.tag in (SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING):
-        pass
-    elif ast.tag == VARARG:
-        scope = ast.getscope()
-        while scope:
-            if scope.getvar('...'):
-                return
-            if scope.isfn():
-                raise RuntimeError("vararg ... is not declared in the current function")
-            scope = scope.getscope()
-        else: raise RuntimeError("vararg ... is not declared in the current function")
-    elif ast.tag == IDENTIFIER:
-        if ast.value in builtins:
-            return
-        if len(ast.value) == 2 and ast.value[0] == '$' and ast.value[1].isdigit():
-            n = int(ast.value[1])
+def parse(ast, lazy=False, host=()):
+    """
+    解析ast，进行作用域分析。lazy为真时fn的函数体延迟到第一次调用时parse，见parse_lazy。
+    host是宿主提供的名字(见interpret的env)，和内置函数一样不做作用域分析，记录在ast.host
+    """
+    outer = parsing.symtab is None
+    if outer:
+        symtab = parsing.symtab = SymbolTable.enter(ast)
+        symtab.lazy = lazy
+        symtab.host = ast.host = frozenset(host)
+    try:
+        drive(parse_node(ast))
+    finally:
+        if outer:
+            parsing.symtab = None
+
+def drive(parser):
+    """
+    各个parse_xxx都是生成器，yield出的子生成器由这里的显式栈驱动执行完毕后，
+    父生成器才继续执行，所以嵌套再深也不会递归调用Python函数。
+    """
+    stack = [parser]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+        else:
+            stack.append(child)
+
+def prescan(fn, body):
+    """
+    延迟parse的fn函数体的预扫描：不做作用域分析，只找出函数体中所有名字，
+    解析到fn之外的登记为捕获变量，返回name -> 作用域。
+    函数体中有$N时可能改变外层hash函数的参数个数，返回None，不能延迟。
+    """
+    symtab = parsing.symtab
+    names = {}
+    seen = set()
+    nodes = list(body)
+    while nodes:
+        node = nodes.pop()
+        if node.tag == IDENTIFIER:
+            name = node.value
+        elif node.tag == MULTI_IDENTIFIER:
+            name = node.value.split('.')[0]
+        else:
+            if isinstance(node.value, list):
+                nodes.extend(node.value)
+            continue
+        if name in seen or name in builtins or name in symtab.host:
+            continue
+        seen.add(name)
+        if len(name) == 2 and name[0] == '$' and name[1].isdigit():
+            return None
+        scope = symtab.lookup(name)
+        if scope is not None and scope.depth < fn.depth:
+            names[name] = symtab.query(name)
+    return names
+
+def parse_lazy(fn):
+    """
+    第一次调用时parse延迟的fn函数体。外层的名字只能看到预扫描时的结果，
+    和定义处直接parse的作用域相同；函数体中的fn仍然延迟。
+    """
+    table = SymbolTable.enter(fn, fn.lazy)
+    table.lazy = True
+    root = fn
+    while root.parent is not None:
+        root = root.parent
+    table.host = root.host
+    table.push(fn)
+    fn.lazy = None
+    saved, parsing.symtab = parsing.symtab, table
+    try:
+        drive(parse_body(fn, fn.value[3 if fn.value[1].tag == IDENTIFIER else 2:]))
+    finally:
+        parsing.symtab = saved
+
+def parse_all(ast):
+    """parse ast中所有延迟的fn函数体"""
+    nodes = [ast]
+    while nodes:
+        node = nodes.pop()
+        if node.lazy is not None:
+            parse_lazy(node)
+        if isinstance(node.value, list):
+            nodes.extend(node.value)
+
+def reparse(root, code, offset, deleted, inserted):
+    """
+    增量更新lex/parse过的root：把code中从offset开始的deleted个字符替换为inserted，返回新的代码。
+    只重新lex和parse修改涉及的顶层form，其他form的子树和作用域分析结果原样保留，
+    之后的form只调整pos。修改后有错误时抛出异常，root保持不变。
+    重新处理的范围从修改之前最近的顶层列表开始，到修改之后最近的行首顶层列表为止，
+    以下情况退回整个重新lex和parse：
+    1. 范围内的括号不再配对，修改影响了后面的form
+    2. 范围以elif/else开头，要和前面的form合并为条件链
+    3. 修改删掉了某个顶层名字的绑定，后面的form可能用到
+    """
+    new_code = code[:offset] + inserted + code[offset+deleted:]
+    delta = len(inserted) - deleted
+    rootfn = root.value[0]
+    if rootfn.lazy is not None:
+        parse_lazy(rootfn)
+    items = rootfn.value
+    ia = bisect.bisect_right(items, offset, 2, key=toplevel_pos)
+    while ia > 2 and not is_anchor(code, items, ia - 1, offset, False):
+        ia -= 1
+    if ia > 2:
+        ia -= 1
+        begin = items[ia].pos - 1
+    else:
+        begin = 0
+    ib = bisect.bisect_right(items, offset + deleted, ia, key=toplevel_pos)
+    while ib < len(items) and not is_anchor(code, items, ib, offset + deleted, True):
+        ib += 1
+    if ib < len(items):
+        end = items[ib].pos - 1 + delta
+    else:
+        end = len(new_code)
+
+    chunk = new_code[begin:end]
+    last = None
+    for last in form_boundaries(chunk):
+        pass
+    if last != len(chunk):
+        return reparse_all(root, new_code)
+    forms = lex(chunk).value[0].value[2:]
+    if forms and forms[0].tag == CODE_LIST and forms[0].value[0].tag == IDENTIFIER and \
+       forms[0].value[0].value in ('elif', 'else'):
+        return reparse_all(root, new_code)
+    for form in forms:
+        shift_pos(form, begin)
+        form.defines = set()
+    old = items[ia:ib]
+    removed = set()
+    for form in old:
+        removed.update(form_defines(form))
+    # 新的form只能看到范围之前的form绑定的名字
+    names = {}
+    for name in walk_names(forms):
+        definer = rootfn.definers.get(name)
+        if definer is not None and name not in removed and toplevel_pos(definer) < begin:
+            names[name] = rootfn
+
+    # 新的form放到rootfn中parse，if/elif/else要在rootfn中合并为条件链
+    if rootfn.boundvars is None:
+        rootfn.boundvars = set()
+    rootfn.boundvars -= removed
+    tail = len(items) - ib
+    items[ia:ib] = forms
+    relink(rootfn, ia - 1, ia + len(forms) + 1)
+    table = SymbolTable.enter(rootfn.value[0], names)
+    table.host = root.host
+    captured = rootfn.captured
+    saved, parsing.symtab = parsing.symtab, table
+    try:
+        for form in forms:
+            table.form = form
+            drive(parse_node(form))
+    except:
+        restore(rootfn, ia, len(items) - tail, old, forms, removed, captured)
+        raise
+    finally:
+        parsing.symtab = saved
+    forms = items[ia:len(items)-tail]
+    defined = set()
+    for form in forms:
+        defined.update(form_defines(form))
+    if removed - defined:
+        restore(rootfn, ia, len(items) - tail, old, forms, removed, captured)
+        return reparse_all(root, new_code)
+    added = defined - removed
+    if added:
+        # 后面的form中内层作用域绑定的同名变量现在遮蔽了新的顶层名字，不能再展开到外层frame中
+        for form in items[len(items)-tail:]:
+            for node in walk(form):
+                if node.boundvars and not node.shadowing and not added.isdisjoint(node.boundvars):
+                    node.shadowing = True
+
+    for form in old:
+        for name in form_defines(form):
+            if rootfn.definers.get(name) is form:
+                del rootfn.definers[name]
+    for form in forms:
+        for name in form_defines(form):
+            rootfn.definers[name] = form
+    if delta:
+        for form in items[len(items)-tail:]:
+            shift_pos(form, delta)
+    return new_code
+
+def toplevel_pos(item):
+    """顶层form的位置，parse合并的条件链取第一个form的位置"""
+    while item.pos is None and item.tag == COND_LIST:
+        item = item.value[0]
+    return item.pos
+
+def form_defines(form):
+    """顶层form绑定的名字，parse合并的条件链各分支都是独立的作用域，不绑定顶层的名字"""
+    return () if form.tag == COND_LIST else form.defines
+
+def relink(parent, begin, end):
+    """重新设置parent.value[begin:end]的parent/prev/next"""
+    items = parent.value
+    for i in range(max(begin, 0), min(end, len(items))):
+        item = items[i]
+        item.parent = parent
+        item.prev = items[i-1] if i > 0 else None
+        item.next = items[i+1] if i + 1 < len(items) else None
+
+def restore(rootfn, begin, end, old, forms, removed, captured):
+    """
+    reparse失败时把rootfn.value[begin:end]恢复为原来的form，撤销新form的绑定，
+    以及新form中的closure对rootfn.captured的修改
+    """
+    rootfn.captured = captured
+    rootfn.value[begin:end] = old
+    relink(rootfn, begin - 1, begin + len(old) + 1)
+    for form in forms:
+        rootfn.boundvars.difference_update(form_defines(form))
+    rootfn.boundvars |= removed
+
+def is_anchor(code, items, i, edge, after):
+    """
+    items[i]能否作为reparse范围的边界：未被修改的顶层列表。
+    after为真时是范围的结尾，还要求在行首，保证重新lex的内容不会和它连在一起；
+    并且前面不是紧接着的反引号字符串，它要在读到列表开头后才结束，和单独lex时位置不同
+    """
+    item = items[i]
+    if item.tag not in (CODE_LIST, LIST_LIST, DICT_LIST) or item.pos is None:
+        return False
+    begin = item.pos - 1
+    if code[begin:begin+1] not in ('(', '[', '{'):
+        # .x语法糖生成的CODE_LIST
+        return False
+    if after:
+        prev = items[i-1]
+        return (begin > edge and code[begin-1] == '\n' and
+                not (prev.tag == BACKTICK_STRING and prev.pos == item.pos))
+    return begin < edge
+
+def walk_names(forms):
+    """forms中用到的所有名字"""
+    names = set()
+    nodes = list(forms)
+    while nodes:
+        node = nodes.pop()
+        if node.tag == IDENTIFIER:
+            names.add(node.value)
+        elif node.tag == MULTI_IDENTIFIER:
+            names.add(node.value.split('.')[0])
+        elif isinstance(node.value, list):
+            nodes.extend(node.value)
+    return names
+
+def shift_pos(ast, delta):
+    nodes = [ast]
+    while nodes:
+        node = nodes.pop()
+        if node.pos is not None:
+            node.pos += delta
+        if isinstance(node.value, list):
+            nodes.extend(node.value)
+        if node.head is not None:
+            nodes.append(node.head)
+
+def reparse_all(root, code):
+    """整个重新lex和parse，成功后替换root中的最外层fn"""
+    new = lex(code)
+    parse(new, False, root.host)
+    root.value = []
+    root.append(new.value[0])
+    return code
+
+
+def parse_node(ast):
+    symtab = parsing.symtab
+    if ast.tag in (NONE, TRUE, FALSE):
+        pass
+    elif ast.tag in (INTEGER, FLOAT):
+        pass
+    elif ast.tag in (SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING):
+        pass
+    elif ast.tag == VARARG:
+        scope = symtab.lookup('...')
+        if not scope or (symtab.fns and symtab.fns[-1].depth > scope.depth):
+            raise RuntimeError("vararg ... is not declared in the current function")
+        ast.scope = scope
+    elif ast.tag == IDENTIFIER:
+        if ast.value in builtins or ast.value in symtab.host:
+            # 内置函数和宿主的名字被局部绑定时是普通变量
+            if symtab.lookup(ast.value) is None:
+                return
+            ast.scope = symtab.query(ast.value)
+            return
+        if len(ast.value) == 2 and ast.value[0] == '$' and ast.value[1].isdigit():
+            n = int(ast.value[1])
             hash = ast.gethashfn()
             if not hash:
                 raise RuntimeError(f"Invalid hash argument {ast.value}")
-            for i in range(1, n+1):
+            # hash函数的参数个数由最大的$N决定
+            for i in range(len(hash.argv)+1, n+1):
                 arg = f'${i}'
                 hash.addvar(arg, True)
-            hash.argv = [f'${i}' for i in range(1, n+1)]
-        var = ast.queryvar()
-        if not var:
+                hash.argv.append(arg)
+            if ast.getfn() is hash:
+                ast.slot = n - 1
+        ast.scope = symtab.query(ast.value)
+        if not ast.scope:
             print(ast.getscope())
             raise RuntimeError(f"Unknown identifier {ast.value}")
     elif ast.tag == MULTI_IDENTIFIER:
-        i = ast.value.index('.')
-        name = ast.value[:i]
-        var = ast.queryvar(name)
-        if not var:
-            raise RuntimeError(f"Unknown identifier {name} in {ast.value}")
+        names = ast.value.split('.')
+        ast.head = AstNode(IDENTIFIER, names[0])
+        ast.head.parent = ast
+        ast.path = [path_key(AstNode(IDENTIFIER, name)) for name in names[1:]]
+        yield parse_node(ast.head)
     elif ast.tag in (AND_REMINDER, AT_WHOLE):
         raise RuntimeError("Invalid &reminder or @whole")
     elif ast.tag == CODE_LIST:
-        parse_code_list(ast)
+        yield parse_code_list(ast)
     elif ast.tag == HASH_LIST:
         if len(ast.value) != 1:
             raise RuntimeError("Invalid hash function")
-        parse(ast.value[0])
+        ast.argv = []
+        symtab.push(ast)
+        yield parse_node(ast.value[0])
+        symtab.pop(ast)
     elif ast.tag == LIST_LIST:
         for item in ast.value:
             if item.suffix:
                 raise RuntimeError(f"Invalid list item suffix '{item.suffix}'")
-            parse(item)
+            yield parse_node(item)
     elif ast.tag == DICT_LIST:
         pairs = []
         key = None
@@ -855,7 +2074,7 @@ def parse(ast):
                     if item.tag == IDENTIFIER:
                         item.tag = INTERN_STRING
                     item.suffix = None
-                    parse(item)
+                    yield parse_node(item)
                     key = item
                     continue
                 else:
@@ -869,19 +2088,24 @@ def parse(ast):
                         key = AstNode(INTERN_STRING, item.value[1].value)
                     else:
                         raise RuntimeError(f"Invalid dict expression: {item}")
-            parse(item)
+            yield parse_node(item)
             pairs.append(mkpair(key, item))
             key = None
         ast.value = []
         for pair in pairs:
             ast.append(pair)
+        keys = [pair.value[0] for pair in pairs]
+        if (keys and all(k.tag == INTERN_STRING for k in keys) and
+                len(set(k.value for k in keys)) == len(keys)):
+            ast.shape = Shape.of(intern_string(k.value) for k in keys)
     else:
         error(f"invalid ast: {ast}")
 
 
 def parse_destructure(ast):
     if ast.tag == IDENTIFIER:
-        ast.addvartoscope(ast.value)
+        if ast.value != '_':
+            ast.addvartoscope(ast.value)
     elif ast.tag == VARARG:
         ast.addvartoscope('...')
     elif ast.tag == LIST_LIST:
@@ -891,7 +2115,7 @@ def parse_destructure(ast):
             elif item.tag in (IDENTIFIER, AND_REMINDER, AT_WHOLE):
                 item.addvartoscope(item.value)
             elif item.tag in (LIST_LIST, DICT_LIST):
-                parse_destructure(item)
+                yield parse_destructure(item)
             else:
                 raise RuntimeError("invalid list destructure")
     elif ast.tag == DICT_LIST:
@@ -903,7 +2127,7 @@ def parse_destructure(ast):
                     if item.tag == IDENTIFIER:
                         item.tag = INTERN_STRING
                     item.suffix = None
-                    parse(item)
+                    yield parse_node(item)
                     key = item
                 elif item.tag == IDENTIFIER:
                     k = AstNode(INTERN_STRING, item.value)
@@ -920,7 +2144,7 @@ def parse_destructure(ast):
                 else:
                     raise RuntimeError("invalid dict destructure")
             elif item.tag in (IDENTIFIER, LIST_LIST, DICT_LIST):
-                parse_destructure(item)
+                yield parse_destructure(item)
                 pairs.append(mkpair(key, item))
                 key = None
             else:
@@ -943,7 +2167,7 @@ def parse_pattern(ast):
     elif ast.tag == IDENTIFIER:
         ast.addvartoscope(ast.value)
     elif ast.tag == CODE_LIST:
-        parse_code_list(ast)
+        yield parse_code_list(ast)
     elif ast.tag == LIST_LIST:
         for item in ast.value:
             if item.suffix:
@@ -955,9 +2179,9 @@ def parse_pattern(ast):
                               INTERN_STRING):
                 pass
             elif item.tag == CODE_LIST:
-                parse_code_list(ast)
+                yield parse_code_list(ast)
             elif item.tag in (LIST_LIST, DICT_LIST):
-                parse_pattern(item)
+                yield parse_pattern(item)
             else:
                 raise RuntimeError("invalid list destructure")
     elif ast.tag == DICT_LIST:
@@ -969,7 +2193,7 @@ def parse_pattern(ast):
                     if item.tag == IDENTIFIER:
                         item.tag = INTERN_STRING
                     item.suffix = None
-                    parse(item)
+                    yield parse_node(item)
                     key = item
                 elif item.tag == IDENTIFIER:
                     k = AstNode(INTERN_STRING, item.value)
@@ -988,13 +2212,13 @@ def parse_pattern(ast):
                       item.value[0].tag == IDENTIFIER and
                       item.value[0].value == '.' and
                       item.value[1].tag == IDENTIFIER):
-                    parse(item)
+                    yield parse_node(item)
                     k = AstNode(INTERN_STRING, item.value[1].value)
                     pairs.append(mkpair(k, item))
                 else:
                     raise RuntimeError("invalid dict destructure")
             elif item.tag not in (VARARG, AND_REMINDER, AT_WHOLE, HASH_LIST):
-                parse_pattern(item)
+                yield parse_pattern(item)
                 pairs.append(mkpair(key, item))
                 key = None
             else:
@@ -1006,397 +2230,1191 @@ def parse_pattern(ast):
         error(f"invalid ast: {ast}")
     
 
+
+def parse_do(ast):
+    op = ast.value[0]
+    if op.suffix != ':':
+        raise RuntimeError("No ':' after do")
+    ast.special = DO_LIST
+    ast.body = []
+    for item in ast.value[1:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_match(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid match expression")
+    ast.special = MATCH_LIST
+    expr = ast.value[1]
+    if expr.suffix != ':':
+        raise RuntimeError("No ':' after match expression")
+    ast.expr = expr
+    ast.body = []
+    yield parse_node(expr)
+    for item in ast.value[2:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_case(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid case expression")
+    if ast.parent.special != MATCH_LIST:
+        raise RuntimeError("case expression must be in match expression")
+    ast.special = CASE_LIST
+    ast.pattern = []
+    ast.body = []
+    i = 1
+    while i < len(ast.value):
+        pattern = ast.value[i]
+        ast.pattern.append(pattern)
+        i += 1
+        yield parse_pattern(pattern)
+        if pattern.suffix == ':':
+            break
+    else:
+        raise RuntimeError("No ':' after case pattern")
+    if i >= len(ast.value):
+        raise RuntimeError("No body in case expression")
+    for item in ast.value[i:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_caseif(ast):
+    if len(ast.value) < 4:
+        raise RuntimeError("Invalid caseif expression")
+    if ast.parent.special != MATCH_LIST:
+        raise RuntimeError("caseif expression must be in match expression")
+    ast.special = CASEIF_LIST
+    ast.pattern = []
+    ast.body = []
+    i = 1
+    while i < len(ast.value):
+        pattern = ast.value[i]
+        i += 1
+        if pattern.suffix == ':':
+            cond = pattern
+            ast.condition = cond
+            yield parse_node(cond)
+            break
+        else:
+            ast.pattern.append(pattern)
+            yield parse_pattern(pattern)
+    else:
+        raise RuntimeError("No ':' after caseif condition")
+    if i >= len(ast.value):
+        raise RuntimeError("No body in case expression")
+    for item in ast.value[i:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_cases(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid cases expression")
+    if ast.parent.special != MATCH_LIST:
+        raise RuntimeError("cases expression must be in match expression")
+    ast.special = CASES_LIST
+    ast.patterns = []
+    ast.body = []
+    varslist = []
+    i = 1
+    while i < len(ast.value):
+        pattern = ast.value[i]
+        ast.patterns.append(pattern)
+        i += 1
+        yield parse_pattern(pattern)
+        varslist.append(ast.clearvars())
+        if pattern.suffix == ':':
+            break
+    else:
+        raise RuntimeError("No ':' after cases pattern")
+    vars = varslist[0]
+    for vs in varslist[1:]:
+        if vars != vs:
+            print(ast)
+            raise RuntimeError('not same vars in cases patterns')
+    for name in vars or ():
+        ast.addvar(name)
+    if i >= len(ast.value):
+        raise RuntimeError("No body in cases expression")
+    for item in ast.value[i:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_default(ast):
+    if len(ast.value) < 2:
+        raise RuntimeError("Invalid default expression")
+    if ast.parent.special != MATCH_LIST:
+        raise RuntimeError("default expression must be in match expression")
+    if ast.value[0].suffix != ':':
+        raise RuntimeError("No ':' after default")
+    ast.special = DEFAULT_LIST
+    ast.body = []
+    for item in ast.value[1:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_if(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid if expression")
+    ast.special = IF_LIST
+    pred = ast.value[1]
+    if pred.suffix != ':':
+        raise RuntimeError("No ':' after if predication")
+    ast.condition = pred
+    ast.body = []
+    for item in ast.value[1:]:
+        ast.body.append(item)
+        yield parse_node(item)
+
+def parse_if_chain(ast):
+    parent = ast.parent
+    i = parent.index(ast)
+    cond = [ast]
+    next = ast.next
+    while next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value in ('elif', 'else'):
+        yield parse_node(next)
+        cond.append(next)
+        next = next.next
+    if len(cond) > 1:
+        for c in cond:
+            c.remove()
+        cond = mkcond(cond)
+        parent.insert(i, cond)
+
+def parse_else_chain(ast):
+    parent = ast.parent
+    i = parent.index(ast)
+    next = ast.next
+    if next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value == 'else':
+        yield parse_node(next)
+        ast.remove()
+        next.remove()
+        cond = mkcond([ast, next])
+        parent.insert(i, cond)
+
+def parse_elif(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid elif expression")
+    if ast.prev and ast.prev.special not in (IF_LIST, ELIF_LIST):
+        raise RuntimeError("No previous if/elif expression")
+    ast.special = ELIF_LIST
+    pred = ast.value[1]
+    if pred.suffix != ':':
+        raise RuntimeError("No ':' after elif predication")
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_else(ast):
+    if len(ast.value) < 2:
+        raise RuntimeError("Invalid else expression")
+    if ast.value[0].suffix != ':':
+        raise RuntimeError("No ':' after else")
+    if ast.prev and ast.prev.special not in (IF_LIST, ELIF_LIST, WHILE_LIST, FOR_LIST, EACH_LIST):
+        raise RuntimeError("No previous if/elif/while/for/each expression")
+    ast.special = ELSE_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_while(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid while expression")
+    ast.special = WHILE_LIST
+    pred = ast.value[1]
+    if pred.suffix != ':':
+        raise RuntimeError("No ':' after while predication")
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_for(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid for expression")
+    ast.special = FOR_LIST
+    pred = ast.value[1]
+    if pred.suffix != ':':
+        raise RuntimeError("No ':' after for parameter list")
+    if pred.tag != LIST_LIST:
+        raise RuntimeError("Invalid for parameter list")
+    if len(pred.value) not in (3, 4):
+        raise RuntimeError("Invalid for parameter list")
+    if pred.value[0].tag != IDENTIFIER:
+        raise RuntimeError("Invalid for parameter")
+    for item in pred.value[1:]:
+        yield parse_node(item)
+    # 绑定标识符应放到求值之后
+    pred.addvartoscope(pred.value[0].value)
+    for item in ast.value[2:]:
+        yield parse_node(item)
+
+def parse_each(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid each expression")
+    ast.special = EACH_LIST
+    pred = ast.value[1]
+    if pred.suffix != ':':
+        raise RuntimeError("No ':' after each parameter list")
+    if pred.tag != LIST_LIST:
+        raise RuntimeError("Invalid each parameter list")
+    if len(pred.value) < 2:
+        raise RuntimeError("Invalid each parameter list")
+    yield parse_node(pred.value[-1])
+    # 绑定标识符应放到求值之后
+    for item in pred.value[:-1]:
+        yield parse_destructure(item)
+
+    for item in ast.value[2:]:
+        yield parse_node(item)
+
+def parse_break(ast):
+    ast.special = BREAK_LIST
+
+def parse_continue(ast):
+    ast.special = CONTINUE_LIST
+
+def parse_fn(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid fn expression")
+    ast.special = FN_LIST
+    ai = 1
+    if ast.value[1].tag == IDENTIFIER:
+        ast.addvartoscope(ast.value[1].value)
+        ai = 2
+    arglist = ast.value[ai]
+    if arglist.suffix != ':':
+        raise RuntimeError("No ':' after fn parameter list")
+    if arglist.tag != LIST_LIST:
+        raise RuntimeError("Invalid fn parameter list")
+    argv = []
+    for arg in arglist.value:
+        if arg.tag == IDENTIFIER:
+            arg.addvartoscope(arg.value)
+            argv.append(arg.value)
+        elif arg.tag == VARARG:
+            arg.addvartoscope('...')
+            argv.append('...')
+        else:
+            raise RuntimeError(f"Invalid fn argument: {arg}")
+    ast.argv = argv
+    if argv and argv[-1] == '...':
+        ast.nfixed = len(argv) - 1
+    body = ast.value[ai+1:]
+    if parsing.symtab.lazy:
+        names = prescan(ast, body)
+        if names is not None:
+            ast.lazy = names
+            return
+    yield parse_body(ast, body)
+
+def parse_body(fn, body):
+    """
+    parse函数体。程序最外层的fn记录每个顶层form绑定的名字(form.defines)
+    以及每个名字由哪个顶层form绑定(fn.definers)，reparse据此只重新parse修改过的form
+    """
+    if fn.parent is None or fn.parent.parent is not None:
+        for item in body:
+            yield parse_node(item)
+        return
+    fn.definers = {}
+    symtab = parsing.symtab
+    for item in body:
+        item.defines = set()
+        symtab.form = item
+        yield parse_node(item)
+    symtab.form = None
+
+def parse_let(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid let expression")
+    ast.special = LET_LIST
+    yield parse_node(ast.value[-1])
+    # 绑定标识符应放到求值之后
+    for item in ast.value[1:-1]:
+        yield parse_destructure(item)
+
+def parse_var(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid var expression")
+    ast.special = VAR_LIST
+    yield parse_node(ast.value[-1])
+    # 绑定标识符应放到求值之后
+    for item in ast.value[1:-1]:
+        yield parse_destructure(item)
+
+def parse_set(ast):
+    if len(ast.value) != 3:
+        raise RuntimeError("Invalid set expression")
+    ast.special = SET_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_import(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid import expression")
+    ast.special = IMPORT_LIST
+    yield parse_node(ast.value[-1])
+    # 绑定标识符应放到求值之后
+    for item in ast.value[1:-1]:
+        yield parse_destructure(item)
+
+def parse_dot(ast):
+    if len(ast.value) < 2:
+        raise RuntimeError("Invalid . expression")
+    ast.special = DOT_LIST
+    keys = ast.value[2:]
+    if all(k.tag in (INTEGER, SINGLE_STRING, DOUBLE_STRING, INTERN_STRING) for k in keys):
+        ast.path = [path_key(k) for k in keys]
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_pass(ast):
+    ast.special = PASS_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_and(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid and expression")
+    ast.special = AND_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_or(ast):
+    if len(ast.value) < 3:
+        raise RuntimeError("Invalid or expression")
+    ast.special = OR_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_not(ast):
+    if len(ast.value) != 2:
+        raise RuntimeError("Invalid not expression")
+    ast.special = NOT_LIST
+    yield parse_node(ast.value[1])
+
+def parse_question(ast):
+    if len(ast.value) != 4:
+        raise RuntimeError("Invalid ? expression")
+    ast.special = QUESTION_LIST
+    for item in ast.value[1:]:
+        yield parse_node(item)
+
+def parse_try(ast):
+    raise RuntimeError("not support try")
+
+def parse_catch(ast):
+    raise RuntimeError("not support catch")
+
+def parse_finally(ast):
+    raise RuntimeError("not support finally")
+
+def parse_throw(ast):
+    raise RuntimeError("not support throw")
+
+
+# 特殊CODE_LIST的parse函数，返回需要驱动执行的生成器，或者None
+code_list_parsers = {
+    '.': parse_dot,
+    'do': parse_do,
+    'match': parse_match,
+    'case': parse_case,
+    'caseif': parse_caseif,
+    'cases': parse_cases,
+    'default': parse_default,
+    'if': parse_if,
+    'elif': parse_elif,
+    'else': parse_else,
+    'while': parse_while,
+    'for': parse_for,
+    'each': parse_each,
+    'break': parse_break,
+    'continue': parse_continue,
+    'fn': parse_fn,
+    'let': parse_let,
+    'var': parse_var,
+    'set': parse_set,
+    'import': parse_import,
+    'pass': parse_pass,
+    'and': parse_and,
+    'or': parse_or,
+    'not': parse_not,
+    '?': parse_question,
+    'try': parse_try,
+    'catch': parse_catch,
+    'finally': parse_finally,
+    'throw': parse_throw,
+}
+
+# if/while/for/each之后的elif/else在离开本作用域后parse，和if并列
+code_list_chains = {
+    'if': parse_if_chain,
+    'while': parse_else_chain,
+    'for': parse_else_chain,
+    'each': parse_else_chain,
+}
+
 def parse_code_list(ast):
-        if not ast.value:
-            raise RuntimeError("Invalid empty code list")
+    if not ast.value:
+        raise RuntimeError("Invalid empty code list")
+    op = ast.value[0]
+    if op.tag == IDENTIFIER and op.value in new_scope_creators:
+        symtab = parsing.symtab
+        symtab.push(ast)
+        parser = code_list_parsers[op.value](ast)
+        if parser:
+            yield parser
+        symtab.pop(ast)
+        if op.value in code_list_chains:
+            yield code_list_chains[op.value](ast)
+    elif op.tag == IDENTIFIER and op.value in code_list_parsers:
+        parser = code_list_parsers[op.value](ast)
+        if parser:
+            yield parser
+    else:
+        for item in ast.value:
+            yield parse_node(item)
 
-        def parse_do(ast):
-            op = ast.value[0]
-            if op.suffix != ':':
-                raise RuntimeError("No ':' after do")
-            ast.special = DO_LIST
-            ast.body = []
-            for item in ast.value[1:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_match(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid match expression")
-            ast.special = MATCH_LIST
-            expr = ast.value[1]
-            if expr.suffix != ':':
-                raise RuntimeError("No ':' after match expression")
-            ast.expr = expr
-            ast.body = []
-            parse(expr)
-            for item in ast.value[2:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_case(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid case expression")
-            if ast.parent.special != MATCH_LIST:
-                raise RuntimeError("case expression must be in match expression")
-            ast.special = CASE_LIST
-            ast.pattern = []
-            ast.body = []
-            i = 1
-            while i < len(ast.value):
-                pattern = ast.value[i]
-                ast.pattern.append(pattern)
-                i += 1
-                parse_pattern(pattern)
-                if pattern.suffix == ':':
-                    break
+
+# 点路径中不存在的key
+missing = object()
+
+def first(value):
+    """只需要一个值的地方取多个值中的第一个"""
+    if value.__class__ is not Values:
+        return value
+    return value.value[0] if value.value else None
+
+def getpath(ast, value, path):
+    """
+    按path逐层取值。record按ast上每一层的inline cache(shape, offset)直接取slot，
+    不查key；ast为None(key不是常量)时不缓存。
+    """
+    ics = None
+    if ast is not None:
+        if ast.ics is None:
+            ast.ics = [None] * len(path)
+        ics = ast.ics
+    for i, key in enumerate(path):
+        cls = value.__class__
+        if cls is Record:
+            # 同一位置上一次遇到的shape，直接使用缓存的offset
+            ic = ics[i] if ics else None
+            if ic is not None and ic[0] is value.shape:
+                item = value.slots[ic[1]]
             else:
-                raise RuntimeError("No ':' after case pattern")
-            if i >= len(ast.value):
-                raise RuntimeError("No body in case expression")
-            for item in ast.value[i:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_caseif(ast):
-            if len(ast.value) < 4:
-                raise RuntimeError("Invalid caseif expression")
-            if ast.parent.special != MATCH_LIST:
-                raise RuntimeError("caseif expression must be in match expression")
-            ast.special = CASEIF_LIST
-            ast.pattern = []
-            ast.body = []
-            i = 1
-            while i < len(ast.value):
-                pattern = ast.value[i]
-                i += 1
-                if pattern.suffix == ':':
-                    cond = pattern
-                    ast.condition = cond
-                    parse(cond)
-                    break
+                offset = value.shape.offsets.get(key)
+                if offset is None:
+                    item = missing
                 else:
-                    ast.pattern.append(pattern)
-                    parse_pattern(pattern)
-            else:
-                raise RuntimeError("No ':' after caseif condition")
-            if i >= len(ast.value):
-                raise RuntimeError("No body in case expression")
-            for item in ast.value[i:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_cases(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid cases expression")
-            if ast.parent.special != MATCH_LIST:
-                raise RuntimeError("cases expression must be in match expression")
-            ast.special = CASES_LIST
-            ast.patterns = []
-            ast.body = []
-            varslist = []
-            i = 1
-            while i < len(ast.value):
-                pattern = ast.value[i]
-                ast.patterns.append(pattern)
-                i += 1
-                parse_pattern(pattern)
-                varslist.append(ast.boundvars)
-                ast.boundvars = None
-                if pattern.suffix == ':':
-                    break
-            else:
-                raise RuntimeError("No ':' after cases pattern")
-            vars = varslist[0]
-            for vs in varslist[1:]:
-                if vars != vs:
-                    print(ast)
-                    raise RuntimeError('not same vars in cases patterns')
-            ast.boundvars = vars
-            if i >= len(ast.value):
-                raise RuntimeError("No body in cases expression")
-            for item in ast.value[i:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_default(ast):
-            if len(ast.value) < 2:
-                raise RuntimeError("Invalid default expression")
-            if ast.parent.special != MATCH_LIST:
-                raise RuntimeError("default expression must be in match expression")
-            if ast.value[0].suffix != ':':
-                raise RuntimeError("No ':' after default")
-            ast.special = DEFAULT_LIST
-            ast.body = []
-            for item in ast.value[1:]:
-                ast.body.append(item)
-                parse(item)
-        def parse_if(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid if expression")
-            ast.special = IF_LIST
-            pred = ast.value[1]
-            if pred.suffix != ':':
-                raise RuntimeError("No ':' after if predication")
-            ast.condition = pred
-            ast.body = []
-            for item in ast.value[1:]:
-                ast.body.append(item)
-                parse(item)
-            parent = ast.parent
-            i = parent.index(ast)
-            cond = [ast]
-            next = ast.next
-            while next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value in ('elif', 'else'):
-                parse(next)
-                cond.append(next)
-                next = next.next
-            if len(cond) > 1:
-                for c in cond:
-                    c.remove()
-                cond = mkcond(cond)
-                parent.insert(i, cond)
-        def parse_elif(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid elif expression")
-            if ast.prev and ast.prev.special not in (IF_LIST, ELIF_LIST):
-                raise RuntimeError("No previous if/elif expression")
-            ast.special = ELIF_LIST
-            pred = ast.value[1]
-            if pred.suffix != ':':
-                raise RuntimeError("No ':' after elif predication")
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_else(ast):
-            if len(ast.value) < 2:
-                raise RuntimeError("Invalid else expression")
-            if ast.value[0].suffix != ':':
-                raise RuntimeError("No ':' after else")
-            if ast.prev and ast.prev.special not in (IF_LIST, ELIF_LIST, WHILE_LIST, FOR_LIST, EACH_LIST):
-                raise RuntimeError("No previous if/elif/while/for/each expression")
-            ast.special = ELSE_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_while(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid while expression")
-            ast.special = WHILE_LIST
-            pred = ast.value[1]
-            if pred.suffix != ':':
-                raise RuntimeError("No ':' after while predication")
-            for item in ast.value[1:]:
-                parse(item)
-            parent = ast.parent
-            i = parent.index(ast)
-            next = ast.next
-            if next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value == 'else':
-                parse(next)
-                ast.remove()
-                next.remove()
-                cond = mkcond([ast, next])
-                parent.insert(i, cond)
-        def parse_for(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid for expression")
-            ast.special = FOR_LIST
-            pred = ast.value[1]
-            if pred.suffix != ':':
-                raise RuntimeError("No ':' after for parameter list")
-            if pred.tag != LIST_LIST:
-                raise RuntimeError("Invalid for parameter list")
-            if len(pred.value) not in (3, 4):
-                raise RuntimeError("Invalid for parameter list")
-            if pred.value[0].tag != IDENTIFIER:
-                raise RuntimeError("Invalid for parameter")
-            for item in pred.value[1:]:
-                parse(item)
-            # 绑定标识符应放到求值之后
-            pred.addvartoscope(pred.value[0].value)
-            for item in ast.value[2:]:
-                parse(item)
-            parent = ast.parent
-            i = parent.index(ast)
-            next = ast.next
-            if next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value == 'else':
-                parse(next)
-                ast.remove()
-                next.remove()
-                cond = mkcond([ast, next])
-                parent.insert(i, cond)
-        def parse_each(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid each expression")
-            ast.special = EACH_LIST
-            pred = ast.value[1]
-            if pred.suffix != ':':
-                raise RuntimeError("No ':' after each parameter list")
-            if pred.tag != LIST_LIST:
-                raise RuntimeError("Invalid each parameter list")
-            if len(pred.value) < 2:
-                raise RuntimeError("Invalid each parameter list")
-            parse(pred.value[-1])
-            # 绑定标识符应放到求值之后
-            for item in pred.value[:-1]:
-                parse_destructure(item)
-
-            for item in ast.value[2:]:
-                parse(item)
-            parent = ast.parent
-            i = parent.index(ast)
-            next = ast.next
-            if next and next.tag == CODE_LIST and next.value[0].tag == IDENTIFIER and next.value[0].value == 'else':
-                parse(next)
-                ast.remove()
-                next.remove()
-                cond = mkcond([ast, next])
-                parent.insert(i, cond)
-        def parse_break(ast):
-            ast.special = BREAK_LIST
-        def parse_continue(ast):
-            ast.special = CONTINUE_LIST
-        def parse_fn(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid fn expression")
-            ast.special = FN_LIST
-            ai = 1
-            if ast.value[1].tag == IDENTIFIER:
-                ast.addvartoscope(ast.value[1].value)
-                ai = 2
-            arglist = ast.value[ai]
-            if arglist.suffix != ':':
-                raise RuntimeError("No ':' after fn parameter list")
-            if arglist.tag != LIST_LIST:
-                raise RuntimeError("Invalid fn parameter list")
-            argv = []
-            for arg in arglist.value:
-                if arg.tag == IDENTIFIER:
-                    arg.addvartoscope(arg.value)
-                    argv.append(arg.value)
-                elif arg.tag == VARARG:
-                    arg.addvartoscope('...')
-                    argv.append('...')
+                    item = value.slots[offset]
+                    if ics:
+                        ics[i] = (value.shape, offset)
+        elif cls is Dict:
+            item = value.value.get(dict_key(key), missing)
+        elif cls is List and key.__class__ is int:
+            item = value.value[key] if key < len(value.value) else missing
+        else:
+            raise RuntimeError(f"Can not get {display(key, True)} from {display(value, True)}")
+        if item is missing:
+            raise RuntimeError(f"{display(key, True)} not found in {display(value, True)}")
+        value = item
+    return value
+
+
+# pmap/peach使用的线程/进程数，None表示os.cpu_count()
+pmap_workers = None
+
+# 没有指定每段元素个数时，每个worker平均分到的段数
+pmap_chunks_per_worker = 4
+
+def form_source(code, begin):
+    """code中从begin开始的一个列表或#列表的源代码，找不到结尾时返回None"""
+    depth = 0
+    for m in form_tokens[False].finditer(code, begin):
+        kind = m.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+            if depth == 0:
+                return code[begin:m.end()]
+            if depth < 0:
+                return None
+    return None
+
+# pmap在子进程中执行的fry函数：(ast, 捕获变量的值)，由pmap_init设置
+shipped = None
+
+def pmap_init(source, values):
+    """pmap进程池worker的初始化：每个worker只parse一次发送来的函数，捕获变量作为宿主的名字"""
+    global shipped
+    root = lex(f'(map {source} items)')
+    parse(root, False, list(values) + ['items'])
+    shipped = root, values
+
+def pmap_chunk(items):
+    root, values = shipped
+    return interpret(root, env=dict(values, items=List(items))).value
+
+def builtin_functions(call, ship=None):
+    """
+    内置函数，call(op, args)用来调用map/filter的函数参数。
+    ship(closure)返回pmap把closure发送到子进程执行需要的(源代码, 捕获变量的值)，不能发送时返回None
+    """
+    def error(msg):
+        raise RuntimeError(msg)
+
+    def numbers(name, args):
+        for arg in args:
+            if arg.__class__ is not int and arg.__class__ is not float:
+                error(f"{name}: Invalid number {display(arg, True)}")
+        return args
+
+    def arithmetic(name, op):
+        def builtin(args):
+            if len(args) < 2:
+                error(f"{name}: Too less arguments")
+            ns = numbers(name, args)
+            n = ns[0]
+            for m in ns[1:]:
+                n = op(n, m)
+            return n
+        return builtin
+
+    def comparison(name, op):
+        def builtin(args):
+            if len(args) < 2:
+                error(f"{name}: Too less arguments")
+            for a, b in zip(args, args[1:]):
+                if isinstance(a, str) or isinstance(b, str):
+                    if not (isinstance(a, str) and isinstance(b, str)):
+                        error(f"{name}: Can not compare {display(a, True)} and {display(b, True)}")
                 else:
-                    raise RuntimeError(f"Invalid fn argument: {arg}")
-            ast.argv = argv
-            for item in ast.value[ai+1:]:
-                parse(item)
-        def parse_let(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid let expression")
-            ast.special = LET_LIST
-            parse(ast.value[-1])
-            # 绑定标识符应放到求值之后
-            for item in ast.value[1:-1]:
-                parse_destructure(item)
-        def parse_var(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid var expression")
-            ast.special = VAR_LIST
-            parse(ast.value[-1])
-            # 绑定标识符应放到求值之后
-            for item in ast.value[1:-1]:
-                parse_destructure(item)
-        def parse_set(ast):
-            if len(ast.value) != 3:
-                raise RuntimeError("Invalid set expression")
-            ast.special = SET_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_import(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid import expression")
-            ast.special = IMPORT_LIST
-            parse(ast.value[-1])
-            # 绑定标识符应放到求值之后
-            for item in ast.value[1:-1]:
-                parse_destructure(item)
-        def parse_pass(ast):
-            ast.special = PASS_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_and(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid and expression")
-            ast.special = AND_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_or(ast):
-            if len(ast.value) < 3:
-                raise RuntimeError("Invalid or expression")
-            ast.special = AND_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_not(ast):
-            if len(ast.value) != 2:
-                raise RuntimeError("Invalid not expression")
-            ast.special = NOT_LIST
-            parse(ast.value[1])
-        def parse_question(ast):
-            if len(ast.value) != 4:
-                raise RuntimeError("Invalid ? expression")
-            ast.special = QUESTION_LIST
-            for item in ast.value[1:]:
-                parse(item)
-        def parse_try(ast):
-            raise RuntimeError("not support try")
-        def parse_catch(ast):
-            raise RuntimeError("not support catch")
-        def parse_finally(ast):
-            raise RuntimeError("not support finally")
-        def parse_throw(ast):
-            raise RuntimeError("not support throw")
-
-        specials = {
-            'do': parse_do,
-            'match': parse_match,
-            'case': parse_case,
-            'caseif': parse_caseif,
-            'cases': parse_cases,
-            'default': parse_default,
-            'if': parse_if,
-            'elif': parse_elif,
-            'else': parse_else,
-            'while': parse_while,
-            'for': parse_for,
-            'each': parse_each,
-            'break': parse_break,
-            'continue': parse_continue,
-            'fn': parse_fn,
-            'let': parse_let,
-            'var': parse_var,
-            'set': parse_set,
-            'import': parse_import,
-            'pass': parse_pass,
-            'and': parse_and,
-            'or': parse_or,
-            'not': parse_not,
-            '?': parse_question,
-            'try': parse_try,
-            'catch': parse_catch,
-            'finally': parse_finally,
-            'throw': parse_throw,
-        }
+                    numbers(name, (a, b))
+                if not op(a, b):
+                    return False
+            return True
+        return builtin
 
-        op = ast.value[0]
-        if op.tag == IDENTIFIER and op.value in specials:
-                specials[op.value](ast)
+    def builtin_add(args):
+        if args and all(isinstance(arg, str) for arg in args):
+            return ''.join(args)
+        return arithmetic('+', operator.add)(args)
+
+    def builtin_sub(args):
+        if len(args) == 1:
+            return -numbers('-', args)[0]
+        return arithmetic('-', operator.sub)(args)
+
+    def builtin_eq(args):
+        if len(args) < 2:
+            error("=: Too less arguments")
+        return all(equal(arg, args[0]) for arg in args[1:])
+
+    def builtin_ne(args):
+        return not builtin_eq(args)
+
+    def builtin_pp(args):
+        if len(args) != 1:
+            error("++: Invalid arguments")
+        return numbers('++', args)[0] + 1
+
+    def builtin_mm(args):
+        if len(args) != 1:
+            error("--: Invalid arguments")
+        return numbers('--', args)[0] - 1
+
+    def builtin_is(args):
+        if len(args) < 2:
+            error("is: Too less arguments")
+        return all(arg is args[0] for arg in args[1:])
+
+    def builtin_len(args):
+        if len(args) != 1:
+            error("len: Invalid arguments")
+        if isinstance(args[0], str):
+            return len(args[0])
+        if args[0].__class__ not in (List, Dict, Record):
+            error("len: Invalid arguments")
+        return len(args[0].value)
+
+    def builtin_print(args):
+        print(*(display(arg) for arg in args))
+
+    def builtin_values(args):
+        if not args:
+            return None
+        if len(args) == 1:
+            return args[0]
+        return Values(args)
+
+    def builtin_map(args):
+        """(map f list)返回f作用于每个元素的List，dict的key和value作为f的两个参数"""
+        if len(args) != 2:
+            error("map: Invalid arguments")
+        f, seq = args
+        if seq.__class__ is List:
+            return List([call(f, [item]) for item in seq.value])
+        elif isinstance(seq, Dict):
+            return List([call(f, [plain_key(k), v]) for k, v in seq.value.items()])
+        error(f"map: Can not iterate {seq}")
+
+    def builtin_filter(args):
+        if len(args) != 2:
+            error("filter: Invalid arguments")
+        f, seq = args
+        if seq.__class__ is List:
+            return List([item for item in seq.value if call(f, [item])])
+        elif isinstance(seq, Dict):
+            return Dict({k: v for k, v in seq.value.items() if call(f, [plain_key(k), v])})
+        error(f"filter: Can not iterate {seq}")
+
+    def parallel(name, args):
+        """
+        (pmap f list)/(pmap f list n)：list按每段n个元素切分后分给多个worker执行，
+        结果按原来的顺序拼接；有段出错时抛出顺序最靠前的出错段的异常。
+        f是宿主或内置的PyFunction时在线程池中执行，适合释放GIL的宿主函数；
+        transpile生成的fry函数可能set捕获的变量，和closure一样不在线程中执行；
+        f是可以发送的closure时在进程池中执行，每个worker只接收一次函数和捕获变量；
+        其他情况(包括只有一段或一个worker)按顺序执行，和map相同。
+        没有指定n时切分为worker数 * pmap_chunks_per_worker段
+        """
+        if len(args) not in (2, 3):
+            error(f"{name}: Invalid arguments")
+        f, seq = args[0], args[1]
+        if seq.__class__ is not List:
+            error(f"{name}: Can not iterate {display(seq, True)}")
+        items = seq.value
+        workers = pmap_workers or os.cpu_count() or 1
+        if len(args) == 3:
+            size = args[2]
+            if size.__class__ is not int or size < 1:
+                error(f"{name}: Invalid chunk size {display(size, True)}")
         else:
-            for item in ast.value:
-                parse(item)
+            size = max(-(-len(items) // (workers * pmap_chunks_per_worker)), 1)
+        chunks = [items[i:i+size] for i in range(0, len(items), size)]
+        if len(chunks) > 1 and workers > 1:
+            if f.__class__ is PyFunction and not f.compiled:
+                pf = f.value
+                with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                    results = pool.map(lambda chunk: [pf([item]) for item in chunk], chunks)
+                    return [value for chunk in results for value in chunk]
+            shipping = ship(f) if ship is not None and f.__class__ is Closure else None
+            if shipping is not None:
+                with concurrent.futures.ProcessPoolExecutor(
+                        workers, initializer=pmap_init, initargs=shipping) as pool:
+                    results = pool.map(pmap_chunk, chunks)
+                    return [value for chunk in results for value in chunk]
+        return [call(f, [item]) for item in items]
+
+    def builtin_pmap(args):
+        """并行的map，见parallel"""
+        return List(parallel('pmap', args))
+
+    def builtin_peach(args):
+        """并行地对每个元素调用f，不要结果，见parallel"""
+        parallel('peach', args)
+
+    return {
+        '+': PyFunction(builtin_add),
+        '-': PyFunction(builtin_sub),
+        '*': PyFunction(arithmetic('*', operator.mul)),
+        '/': PyFunction(arithmetic('/', operator.truediv)),
+        '//': PyFunction(arithmetic('//', operator.floordiv)),
+        'mod': PyFunction(arithmetic('mod', operator.mod)),
+        '=': PyFunction(builtin_eq),
+        '!=': PyFunction(builtin_ne),
+        '<': PyFunction(comparison('<', operator.lt)),
+        '>': PyFunction(comparison('>', operator.gt)),
+        '<=': PyFunction(comparison('<=', operator.le)),
+        '>=': PyFunction(comparison('>=', operator.ge)),
+        '++': PyFunction(builtin_pp),
+        '--': PyFunction(builtin_mm),
+        'is': PyFunction(builtin_is),
+        'len': PyFunction(builtin_len),
+        'print': PyFunction(builtin_print),
+        'map': PyFunction(builtin_map),
+        'filter': PyFunction(builtin_filter),
+        'values': PyFunction(builtin_values),
+        'pmap': PyFunction(builtin_pmap),
+        'peach': PyFunction(builtin_peach),
+    }
+
+
+# 优化pass，optimize按这个顺序执行
+OPT_INLINE        = 'inline'          # 小的非递归fn在调用处内联
+OPT_PROPAGATE     = 'propagate'       # 没有被set的let常量替换到使用处
+OPT_FOLD          = 'fold'            # 字面量的算术/比较/and/or/not计算为常量
+OPT_PRUNE         = 'prune'           # 谓词是字面量的if/elif/?去掉不会执行的分支
+
+optimize_passes = (OPT_INLINE, OPT_PROPAGATE, OPT_FOLD, OPT_PRUNE)
+
+# 可以常量折叠的内置函数
+fold_ops = set(['+', '-', '*', '/', '//', 'mod', '=', '!=', '<', '>', '<=', '>=', '++', '--'])
+
+# 常量折叠只调用算术/比较内置函数，不会调用函数参数
+fold_functions = builtin_functions(None)
+
+# 内联的fn函数体最多的节点数
+inline_max_nodes = 24
+
+# 可以内联的函数体中允许的特殊CODE_LIST，None是普通的调用
+inline_specials = set([None, AND_LIST, OR_LIST, NOT_LIST, QUESTION_LIST, DOT_LIST])
+
+# 字面量的ast类型
+literal_tags = (NONE, TRUE, FALSE, INTEGER, FLOAT,
+                SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING)
+
+def literal_value(ast):
+    """字面量ast的值，和interpret中的eval相同"""
+    if ast.tag == NONE:
+        return None
+    elif ast.tag == TRUE:
+        return True
+    elif ast.tag == FALSE:
+        return False
+    elif ast.tag == INTERN_STRING:
+        return intern_string(ast.value)
+    return ast.value
+
+def literal_node(value):
+    """值对应的字面量ast，不能用字面量表示时返回None"""
+    cls = value.__class__
+    if value is None:
+        return AstNode(NONE)
+    elif cls is bool:
+        return AstNode(TRUE if value else FALSE)
+    elif cls is int:
+        return AstNode(INTEGER, value)
+    elif cls is float:
+        return AstNode(FLOAT, value)
+    elif cls is Keyword:
+        return AstNode(INTERN_STRING, str(value))
+    elif cls is str:
+        return AstNode(DOUBLE_STRING, value)
+    return None
+
+def multivalued(ast):
+    """表达式的值是否可能是(values ...)的多个值"""
+    if ast.tag == VARARG:
+        return True
+    if ast.tag == COND_LIST:
+        return ast.value[0].special not in (WHILE_LIST, FOR_LIST, EACH_LIST)
+    if ast.tag != CODE_LIST:
+        return False
+    op = ast.value[0]
+    if op.tag == IDENTIFIER and op.value in code_list_parsers:
+        return op.value in ('do', 'if', '?')
+    if op.tag == IDENTIFIER and op.scope is None and op.value in builtins:
+        return op.value == 'values'
+    return True
+
+def walk(ast):
+    """ast子树的所有节点，父节点在子节点之前，包括点路径开头的标识符"""
+    nodes = [ast]
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        if isinstance(node.value, list):
+            nodes.extend(node.value)
+        if node.head is not None:
+            nodes.append(node.head)
+        i += 1
+    return nodes
+
+def replace_node(old, new):
+    """在父节点中用new替换old"""
+    parent = old.parent
+    i = next(i for i, item in enumerate(parent.value) if item is old)
+    parent.value[i] = new
+    new.parent, new.prev, new.next = parent, old.prev, old.next
+    if old.prev: old.prev.next = new
+    if old.next: old.next.prev = new
+    new.suffix = old.suffix
+    if new.pos is None:
+        new.pos = old.pos
+    old.parent = old.prev = old.next = None
+    if parent.special == DO_LIST:
+        parent.body = parent.value[1:]
+
+def remove_node(ast):
+    parent = ast.parent
+    ast.remove()
+    if parent.special == DO_LIST:
+        parent.body = parent.value[1:]
+
+def to_do(ast):
+    """if/elif/else分支改为do，保留原来的作用域节点"""
+    if ast.special in (IF_LIST, ELIF_LIST):
+        ast.value[1].remove()
+    ast.value[0].value = 'do'
+    ast.value[0].suffix = ':'
+    ast.special = DO_LIST
+    ast.body = ast.value[1:]
+    return ast
+
+def to_else(ast):
+    """if/elif分支改为else"""
+    ast.value[1].remove()
+    ast.value[0].value = 'else'
+    ast.value[0].suffix = ':'
+    ast.special = ELSE_LIST
+    return ast
+
+def body_start(ast):
+    """ast中语句序列开始的序号，不是语句序列时返回None"""
+    special = ast.special
+    if special in (DO_LIST, ELSE_LIST, PASS_LIST):
+        return 1
+    elif special in (IF_LIST, ELIF_LIST, WHILE_LIST, FOR_LIST, EACH_LIST):
+        return 2
+    elif special == FN_LIST:
+        return 3 if ast.value[1].tag == IDENTIFIER else 2
+    return None
+
+def is_statement(ast):
+    """ast在语句序列中并且不是最后一个，值不会被使用"""
+    parent = ast.parent
+    if parent is None or ast.next is None:
+        return False
+    start = body_start(parent)
+    return start is not None and parent.value.index(ast) >= start
+
+
+class Optimizer:
+    """
+    parse之后、执行之前的ast优化，直接修改ast。
+    每个pass执行前后统计节点数，report是每个pass删除的节点数，
+    内联会增加节点时是负数。各pass互相产生新的机会，所以重复执行到没有变化为止。
+    """
+    def __init__(self, root, passes=optimize_passes):
+        self.root = root
+        self.passes = [p for p in optimize_passes if p in passes]
+        self.report = {p: 0 for p in self.passes}
+        self.functions = {
+            OPT_INLINE: self.inline,
+            OPT_PROPAGATE: self.propagate,
+            OPT_FOLD: self.fold,
+            OPT_PRUNE: self.prune,
+        }
+
+    def run(self, rounds=4):
+        for _ in range(rounds):
+            changed = False
+            for name in self.passes:
+                before = len(walk(self.root))
+                if self.functions[name]():
+                    changed = True
+                self.report[name] += before - len(walk(self.root))
+            if not changed:
+                break
+        return self.report
+
+    def assigned(self):
+        """被set的变量(作用域, 名字)，内置函数的作用域是None"""
+        result = set()
+        for node in walk(self.root):
+            if node.special == SET_LIST:
+                target = node.value[1]
+                result.add((target.scope, target.value))
+        return result
+
+    def rebound(self):
+        """
+        被set或者作为参数、let/var等重新绑定的内置函数名。
+        parse不分析内置函数名的作用域，这些名字的使用处scope也是None，不能当作内置函数
+        """
+        result = set(name for scope, name in self.assigned() if scope is None)
+        for node in walk(self.root):
+            if node.boundvars:
+                result.update(name for name in node.boundvars if name in builtins)
+        return result
+
+    def fold(self):
+        changed = False
+        rebound = self.rebound()
+        for node in reversed(walk(self.root)):
+            if node.tag != CODE_LIST or node.parent is None:
+                continue
+            special = node.special
+            args = node.value[1:]
+            if not args or any(arg.tag not in literal_tags for arg in args):
+                continue
+            if special in (AND_LIST, OR_LIST, NOT_LIST):
+                values = [bool(literal_value(arg)) for arg in args]
+                if special == AND_LIST:
+                    value = all(values)
+                elif special == OR_LIST:
+                    value = any(values)
+                else:
+                    value = not values[0]
+            elif special is None:
+                op = node.value[0]
+                if (op.tag != IDENTIFIER or op.scope is not None or
+                        op.value not in fold_ops or op.value in rebound):
+                    continue
+                try:
+                    value = fold_functions[op.value].value([literal_value(arg) for arg in args])
+                except (RuntimeError, ArithmeticError):
+                    # 运行时再报错
+                    continue
+            else:
+                continue
+            literal = literal_node(value)
+            if literal is not None:
+                replace_node(node, literal)
+                changed = True
+        return changed
+
+    def prune(self):
+        changed = False
+        for node in reversed(walk(self.root)):
+            if node.parent is None:
+                continue
+            if node.tag == COND_LIST and node.value[0].special in (IF_LIST, ELIF_LIST):
+                changed = self.prune_chain(node) or changed
+            elif node.tag == CODE_LIST and node.special == IF_LIST and node.parent.tag != COND_LIST:
+                pred = node.value[1]
+                if pred.tag in literal_tags:
+                    if literal_value(pred):
+                        to_do(node)
+                    else:
+                        replace_node(node, AstNode(NONE))
+                    changed = True
+            elif node.tag == CODE_LIST and node.special == QUESTION_LIST:
+                pred = node.value[1]
+                if pred.tag in literal_tags:
+                    branch = node.value[2] if literal_value(pred) else node.value[3]
+                    branch.remove()
+                    replace_node(node, branch)
+                    changed = True
+            elif (node.tag == CODE_LIST and node.special == DO_LIST and
+                    not node.boundvars and len(node.value) == 2):
+                # 没有绑定变量的(do: x)就是x
+                item = node.value[1]
+                item.remove()
+                replace_node(node, item)
+                changed = True
+        return changed
+
+    def prune_chain(self, cond):
+        """if/elif/else链：去掉谓词为假的分支，谓词为真的分支成为else"""
+        branches = [b for b in cond.value if b.special != ELSE_LIST]
+        other = cond.value[-1] if cond.value[-1].special == ELSE_LIST else None
+        if all(b.value[1].tag not in literal_tags for b in branches):
+            return False
+        kept = []
+        for branch in branches:
+            pred = branch.value[1]
+            if pred.tag not in literal_tags:
+                kept.append(branch)
+            elif literal_value(pred):
+                other = to_else(branch)
+                break
+        if not kept:
+            replace_node(cond, to_do(other) if other else AstNode(NONE))
+            return True
+        for item in list(cond.value):
+            item.remove()
+        for item in kept + ([other] if other else []):
+            cond.append(item)
+        return True
+
+    def propagate(self):
+        """let绑定的字面量在没有被set时替换到每个使用处，let的值不再使用时删除let"""
+        changed = False
+        assigned = self.assigned()
+        nodes = walk(self.root)
+        constants = {}
+        for node in nodes:
+            if (node.special == LET_LIST and len(node.value) == 3 and
+                    node.value[1].tag == IDENTIFIER and node.value[1].value != '_' and
+                    node.value[1].value not in builtins and node.value[2].tag in literal_tags):
+                key = (node.value[1].getscope(), node.value[1].value)
+                if key not in assigned:
+                    constants[key] = node
+        if not constants:
+            return False
+        used = set()
+        for node in nodes:
+            if node.tag != IDENTIFIER or node.scope is None:
+                continue
+            key = (node.scope, node.value)
+            let = constants.get(key)
+            if let is None:
+                continue
+            if node.parent is None or node.parent.tag == MULTI_IDENTIFIER:
+                used.add(key)
+                continue
+            literal = AstNode(let.value[2].tag, let.value[2].value)
+            literal.pos = node.pos
+            replace_node(node, literal)
+            changed = True
+        for key, let in constants.items():
+            if key not in used and is_statement(let):
+                scope, name = key
+                remove_node(let)
+                scope.boundvars.discard(name)
+                changed = True
+        return changed
+
+    def inlinable(self, fn, rebound):
+        """返回可以内联的fn的绑定作用域，不能内联时返回None。rebound见self.rebound"""
+        if fn.special != FN_LIST or fn.value[1].tag != IDENTIFIER or fn.nfixed is not None:
+            return None
+        if any(arg in builtins for arg in fn.argv):
+            return None
+        scope = fn.getscope()
+        if fn.parent is not scope or len(fn.value) != 4:
+            return None
+        body = walk(fn.value[3])
+        if len(body) > inline_max_nodes:
+            return None
+        for node in body:
+            if node.tag in literal_tags or node.tag == KV_LIST:
+                continue
+            elif node.tag == IDENTIFIER:
+                # 只能使用参数和内置函数，函数体中的名字和调用处无关
+                if node.scope is fn or (node.scope is None and node.value in builtins and
+                                        node.value not in rebound):
+                    continue
+                parent = node.parent
+                if parent.special is not None and parent.value[0] is node:
+                    continue
+            elif node.tag in (MULTI_IDENTIFIER, LIST_LIST, DICT_LIST):
+                continue
+            elif node.tag == CODE_LIST and node.special in inline_specials:
+                continue
+            return None
+        return scope
+
+    def inline(self):
+        changed = False
+        assigned = self.assigned()
+        rebound = self.rebound()
+        nodes = walk(self.root)
+        fns = {}
+        for node in nodes:
+            if node.special == FN_LIST:
+                scope = self.inlinable(node, rebound)
+                if scope is not None and (scope, node.value[1].value) not in assigned:
+                    fns[(scope, node.value[1].value)] = node
+        if not fns:
+            return False
+        for node in nodes:
+            if node.tag != CODE_LIST or node.special is not None or node.parent is None:
+                continue
+            op = node.value[0]
+            if op.tag != IDENTIFIER or op.scope is None:
+                continue
+            fn = fns.get((op.scope, op.value))
+            args = node.value[1:]
+            if fn is None or len(args) != len(fn.argv) or any(multivalued(arg) for arg in args):
+                continue
+            replace_node(node, self.expand(fn, args))
+            changed = True
+        if changed:
+            # 所有调用都已内联的fn定义不再需要
+            used = set((node.scope, node.value) for node in walk(self.root)
+                       if node.tag == IDENTIFIER and node.scope is not None)
+            for key, fn in fns.items():
+                if key not in used and is_statement(fn):
+                    scope, name = key
+                    remove_node(fn)
+                    scope.boundvars.discard(name)
+        return changed
+
+    def expand(self, fn, args):
+        """
+        (f a b)展开为(do: (let f:x a) (let f:y b) body)。
+        参数改名为带':'的名字，不会和参数表达式中的变量同名。
+        """
+        name = fn.value[1].value
+        if not args:
+            return clone_node(fn.value[3], fn, None, {})
+        do = AstNode(CODE_LIST, [])
+        do.append(AstNode(IDENTIFIER, 'do', ':'))
+        do.special = DO_LIST
+        do.boundvars = set()
+        do.pos = fn.value[3].pos
+        names = {}
+        for param, arg in zip(fn.argv, args):
+            names[param] = f'{name}:{param}'
+            let = AstNode(CODE_LIST, [])
+            let.special = LET_LIST
+            let.pos = arg.pos
+            let.append(AstNode(IDENTIFIER, 'let'))
+            let.append(AstNode(IDENTIFIER, names[param]))
+            arg.suffix = None
+            let.append(arg)
+            do.append(let)
+            do.boundvars.add(names[param])
+        do.append(clone_node(fn.value[3], fn, do, names))
+        do.body = do.value[1:]
+        return do
+
+
+def clone_node(ast, scope, newscope, names):
+    """复制ast子树，绑定在scope中的变量改为newscope中names对应的新名字"""
+    node = AstNode(ast.tag, None, ast.suffix)
+    for attr in ('special', 'slot', 'nfixed', 'path', 'shape', 'pos', 'scope'):
+        setattr(node, attr, getattr(ast, attr))
+    if ast.tag == IDENTIFIER and ast.scope is scope:
+        node.scope = newscope
+        node.value = names[ast.value]
+    elif isinstance(ast.value, list):
+        node.value = []
+        for item in ast.value:
+            node.append(clone_node(item, scope, newscope, names))
+    else:
+        node.value = ast.value
+    if ast.head is not None:
+        node.head = clone_node(ast.head, scope, newscope, names)
+        node.head.parent = node
+        node.value = '.'.join([node.head.value] + ast.value.split('.')[1:])
+    return node
+
+def optimize(root, passes=optimize_passes):
+    """优化parse过的ast，返回每个pass删除的节点数"""
+    parse_all(root)
+    return Optimizer(root, passes).run()
 
 
-def interpret(code):
-    root = lex(code)
-    parse(root)
+def interpret(code, passes=(), lazy=False, budget=None, env=None):
+    """
+    passes是执行前使用的优化pass，见optimize；lazy为真时fn函数体在第一次调用时parse。
+    code也可以是已经parse过的ast，如reparse增量更新的结果，parse时要传入env中的名字。
+    budget不为None时返回一个生成器，每执行budget步挂起一次(yield None)，用next恢复，
+    生成器结束时返回程序的结果，见Scheduler；宿主函数返回awaitable时yield出awaitable，
+    调用者等待后把结果send回来，见interpret_async。
+    env是宿主提供的name -> 值，Python函数包装为PyFunction，参数约定和内置函数相同(一个参数list)。
+    """
+    env = env or {}
+    if isinstance(code, AstNode):
+        root = code
+    else:
+        root = lex(code)
+        parse(root, lazy, env)
+    if passes:
+        optimize(root, passes)
 
     interns = set()
     g = Frame(root)
     stack = [g]
     frames = {g.id: g} # map[frameid -> frame]
     upvars = {}        # map[frameid -> map[varname -> val]
-
-    none = Value(NONE)
-    true = Value(TRUE)
-    false = Value(FALSE)
+    free = []          # 关闭后可以重用的frame，没有被捕获，vars已清空
 
     def error(msg):
         raise RuntimeError(msg)
 
+    g.vars = builtin_functions(lambda op, args: evaluate(call(op, args)), lambda op: ship(op))
+    builtin_eq_fn = g.vars['=']
+    hosts = set()      # 宿主函数
+    for name, value in env.items():
+        if callable(value) and not isinstance(value, Value):
+            hosts.add(value)
+            value = PyFunction(value)
+        g.vars[name] = value
+
     def getvar(name):
         slen = len(stack)
         for i in range(1, slen+1):
@@ -1412,49 +3430,301 @@ def interpret(code):
                     return Variable(upvars[fid], name)
         error(f"Undefined variable {name}")
 
+    def getvalue(name):
+        """和getvar相同的查找，直接返回变量的值，不生成Variable"""
+        for i in range(len(stack)-1, -1, -1):
+            frame = stack[i]
+            vars = frame.vars
+            if vars and name in vars:
+                return vars[name]
+            if frame.upvars and name in frame.upvars:
+                fid = frame.upvars[name]
+                if fid in frames:
+                    return frames[fid].vars[name]
+                elif fid in upvars:
+                    return upvars[fid][name]
+        error(f"Undefined variable {name}")
+
     def mkframe(ast):
-        frame = Frame(ast)
+        """
+        只有变量被closure捕获的作用域才需要登记到frames，以便按id找到open upvalue。
+        没有被捕获的frame关闭后没有任何引用，放回free重用，id仍然唯一。
+        """
+        if ast.captured:
+            frame = Frame(ast)
+            frames[frame.id] = frame
+        elif free:
+            frame = free.pop()
+            frame.ast = ast
+        else:
+            frame = Frame(ast)
         stack.append(frame)
-        frames[frame.id] = frame
+        return frame
 
     def closeframe(fid=None):
         fid = fid if fid else stack[-1].id
-        if fid in frames:
-            frameid = 0
-            while frameid != fid:
-                frame = stack.pop()
-                frameid = frame.id
-                del frames[frameid]
-                closevars = upvars.get(frameid, {})
+        frameid = 0
+        while frameid != fid:
+            frame = stack.pop()
+            frameid = frame.id
+            if frames.pop(frameid, None) is None:
+                if frame.vars:
+                    frame.vars.clear()
+                frame.upvars = None
+                free.append(frame)
+                continue
+            closevars = upvars.get(frameid)
+            if closevars:
                 for varname in closevars.keys():
-                    closevars[varname] = frame.vars[varname]
+                    closevars[varname] = frame.vars.get(varname)
 
-    def eval_code_do(ast):
-        value = none
-        for exp in ast.body:
-            value = eval(exp)
-        return value
-    def eval_code_match(ast):
-        frame = mkframe(ast)
-        expr = ast.expr
-        value = eval(expr)
-        frame.setvar('$matchvalue', value)
-        frame.setvar('$matched', false)
-        for item in ast.body:
-            eval(item)
-            if getvar('$matched').get():
-                break
-        closeframe(frame.id)
-    def eval_code_case(ast):
-        # TODO
-        frame = mkframe(ast)
+    def unwind(frame):
+        """关闭frame之上的所有frame，用于break/continue跳出嵌套作用域"""
+        if stack[-1] is not frame:
+            closeframe(stack[stack.index(frame)+1].id)
 
-        closeframe(frame.id)
+    def setvar(name, value):
+        """在当前作用域绑定变量"""
+        stack[-1].setvar(name, value)
 
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid case expression")
-        if ast.parent.special != MATCH_LIST:
-            raise RuntimeError("case expression must be in match expression")
+    def capture(closure):
+        """
+        创建closure时，把parse阶段得到的捕获变量对应到运行时的frame。
+        绑定作用域的frame还在栈上时直接使用；否则通过外层closure已捕获的frame找到。
+        """
+        fn = closure.value
+        if not fn.upvars:
+            return
+        for name, scope in fn.upvars.items():
+            for frame in reversed(stack):
+                if frame.ast is scope:
+                    fid = frame.id
+                    break
+                if frame.upvars and name in frame.upvars:
+                    fid = frame.upvars[name]
+                    break
+            else:
+                error(f"Can not capture variable {name}")
+            closure.upvalues[name] = fid
+            if fid in frames:
+                upvars.setdefault(fid, {})[name] = None
+
+    source = code if isinstance(code, str) else None
+
+    def ship(closure):
+        """
+        pmap发送closure到子进程执行需要的(源代码, 捕获变量的值)。以下情况不能发送，返回None：
+        没有源代码；捕获的变量不是不可变的标量；函数中set了捕获变量，或者用到宿主的名字
+        """
+        fn = closure.value
+        if source is None or fn.pos is None:
+            return None
+        text = form_source(source, fn.pos - 1)
+        if text is None:
+            return None
+        values = {}
+        for name, fid in closure.upvalues.items():
+            value = frames[fid].vars[name] if fid in frames else upvars[fid][name]
+            if value is not None and value.__class__ not in (int, float, str, bool, Keyword):
+                return None
+            values[name] = value
+        for node in walk(fn):
+            if node.tag == IDENTIFIER:
+                name = node.value
+            elif node.tag == MULTI_IDENTIFIER:
+                name = node.value.split('.')[0]
+            else:
+                if (node.tag == CODE_LIST and len(node.value) > 2 and
+                        node.value[0].tag == IDENTIFIER and node.value[0].value == 'set' and
+                        node.value[1].value in values):
+                    return None
+                continue
+            if name in root.host:
+                return None
+        return text, values
+
+    # 求值和parse一样由生成器驱动：eval_xxx是生成器，yield出要求值的子节点，
+    # execute求值后把结果send回来，异常throw回去。Python的调用栈不随fry的调用加深，
+    # 执行可以在任意一步挂起(budget)，之后从原处继续。
+    map_fn = g.vars['map']
+    filter_fn = g.vars['filter']
+    pmap_fn = g.vars['pmap']
+    peach_fn = g.vars['peach']
+    # call中不直接调用的内置函数
+    # 按id比较，Value.__eq__太慢
+    suspendable = {id(map_fn), id(filter_fn), id(pmap_fn), id(peach_fn)}
+
+    # 宿主函数返回的awaitable是否yield给调用者等待，见interpret_async
+    awaiting = budget is not None and bool(hosts)
+
+    def eval_body(items):
+        value = None
+        for item in items:
+            value = immediate(item) if item.tag in leaf_tags else (yield item)
+        return value
+
+    def test(ast):
+        """
+        求值谓词，得到Python的bool。
+        and/or/not短路求值，嵌套时不生成中间的true/false。
+        """
+        if ast.tag == CODE_LIST:
+            special = ast.special
+            if special == AND_LIST:
+                for item in ast.value[1:]:
+                    if not (yield from test(item)):
+                        return False
+                return True
+            elif special == OR_LIST:
+                for item in ast.value[1:]:
+                    if (yield from test(item)):
+                        return True
+                return False
+            elif special == NOT_LIST:
+                return not (yield from test(ast.value[1]))
+        elif ast.tag == TRUE:
+            return True
+        elif ast.tag in (FALSE, NONE):
+            return False
+        return bool(immediate(ast) if ast.tag in leaf_tags else (yield ast))
+
+    def flat(ast):
+        """
+        作用域能否不创建Frame，绑定直接放到外层的frame中：
+        变量没有被closure捕获，也没有遮蔽外层的同名变量。
+        """
+        return not ast.captured and not ast.shadowing
+
+    def unbind(frame, names):
+        """离开展开到frame中的作用域时删除它的绑定"""
+        vars = frame.vars
+        if vars:
+            for name in names:
+                vars.pop(name, None)
+
+    def eval_scope(ast, items):
+        """在ast对应的新作用域中执行items"""
+        value = None
+        if flat(ast):
+            if not ast.boundvars:
+                for item in items:
+                    value = immediate(item) if item.tag in leaf_tags else (yield item)
+                return value
+            frame = stack[-1]
+            try:
+                for item in items:
+                    value = immediate(item) if item.tag in leaf_tags else (yield item)
+            finally:
+                unbind(frame, ast.boundvars)
+            return value
+        frame = mkframe(ast)
+        for item in items:
+            value = immediate(item) if item.tag in leaf_tags else (yield item)
+        closeframe(frame.id)
+        return value
+
+    def destructure_record(ast, record):
+        """record按shape解构，key是常量时每个shape只把key解析成offset一次"""
+        shape = record.shape
+        cache = ast.cache
+        if cache is not None and cache[0] is shape:
+            offsets = cache[1]
+        else:
+            offsets = []
+            constant = True
+            for pair in ast.value:
+                key, target = pair.value
+                if target.tag in (AND_REMINDER, AT_WHOLE):
+                    offsets.append(None)
+                    continue
+                constant = constant and key.tag in const_tags
+                k = eval(key)
+                if k not in shape.offsets:
+                    error(f"No key {k} to destructure {ast}")
+                offsets.append(shape.offsets[k])
+            if constant:
+                ast.cache = (shape, offsets)
+        slots = record.slots
+        for pair, offset in zip(ast.value, offsets):
+            target = pair.value[1]
+            if offset is not None:
+                eval_destructure(target, slots[offset])
+            elif target.tag == AT_WHOLE:
+                setvar(target.value, record)
+            else:
+                rest = [i for i in range(len(slots)) if i not in offsets]
+                setvar(target.value, Record(Shape.of(shape.keys[i] for i in rest),
+                                            [slots[i] for i in rest]))
+
+    def eval_destructure(ast, value):
+        """把value按照parse_destructure处理过的模式绑定到当前作用域"""
+        if ast.tag == IDENTIFIER:
+            if ast.value != '_':
+                setvar(ast.value, value)
+        elif ast.tag == VARARG:
+            setvar('...', value)
+        elif ast.tag == LIST_LIST:
+            if value.__class__ is not List:
+                error(f"Can not destructure {display(value, True)} as list")
+            items = value.value
+            for i, item in enumerate(ast.value):
+                if item.tag == AND_REMINDER:
+                    setvar(item.value, List(items[i:]))
+                elif item.tag == AT_WHOLE:
+                    setvar(item.value, value)
+                elif i >= len(items):
+                    error(f"Not enough items to destructure {ast}")
+                else:
+                    eval_destructure(item, items[i])
+        elif ast.tag == DICT_LIST:
+            if not isinstance(value, Dict):
+                error(f"Can not destructure {display(value, True)} as dict")
+            if value.__class__ is Record:
+                return destructure_record(ast, value)
+            items = value.value
+            used = set()
+            for pair in ast.value:
+                key, target = pair.value
+                if target.tag == AND_REMINDER:
+                    continue
+                elif target.tag == AT_WHOLE:
+                    setvar(target.value, value)
+                    continue
+                k = dict_key(eval(key))
+                if k not in items:
+                    error(f"No key {k} to destructure {ast}")
+                used.add(k)
+                eval_destructure(target, items[k])
+            for pair in ast.value:
+                target = pair.value[1]
+                if target.tag == AND_REMINDER:
+                    setvar(target.value, Dict({k: v for k, v in items.items() if k not in used}))
+        else:
+            error(f"invalid destructure: {ast}")
+
+    def eval_code_do(ast):
+        return (yield from eval_scope(ast, ast.body))
+    def eval_code_match(ast):
+        frame = mkframe(ast)
+        expr = ast.expr
+        value = eval(expr)
+        frame.setvar('$matchvalue', value)
+        frame.setvar('$matched', False)
+        for item in ast.body:
+            eval(item)
+            if getvar('$matched').get():
+                break
+        closeframe(frame.id)
+    def eval_code_case(ast):
+        # TODO
+        frame = mkframe(ast)
+
+        closeframe(frame.id)
+
+        if len(ast.value) < 3:
+            raise RuntimeError("Invalid case expression")
+        if ast.parent.special != MATCH_LIST:
+            raise RuntimeError("case expression must be in match expression")
         ast.special = CASE_LIST
         pattern = ast.value[1]
         if pattern.suffix != ':':
@@ -1501,14 +3771,9 @@ def interpret(code):
         for item in ast.value[1:]:
             eval(item)
     def eval_code_if(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid if expression")
-        ast.special = IF_LIST
-        pred = ast.value[1]
-        if pred.suffix != ':':
-            raise RuntimeError("No ':' after if predication")
-        for item in ast.value[1:]:
-            eval(item)
+        if (yield from test(ast.value[1])):
+            return (yield from eval_scope(ast, ast.value[2:]))
+        return None
     def eval_code_elif(ast):
         if len(ast.value) < 3:
             raise RuntimeError("Invalid elif expression")
@@ -1530,95 +3795,184 @@ def interpret(code):
         ast.special = ELSE_LIST
         for item in ast.value[1:]:
             eval(item)
-    def eval_code_while(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid while expression")
-        ast.special = WHILE_LIST
+    def enter(ast):
+        """进入循环的作用域，返回循环变量所在的frame"""
+        return stack[-1] if flat(ast) else mkframe(ast)
+    def leave(ast, frame):
+        if frame.ast is ast:
+            closeframe(frame.id)
+        elif ast.boundvars:
+            unbind(frame, ast.boundvars)
+    def iterate(frame, body):
+        """执行一次循环体，返回是否被break"""
+        try:
+            for item in body:
+                if item.tag in leaf_tags:
+                    immediate(item)
+                else:
+                    yield item
+        except ContinueLoop:
+            unwind(frame)
+        except BreakLoop:
+            unwind(frame)
+            return True
+        return False
+    def loop_while(ast):
+        """
+        返回循环是否被break。
+        循环作用域的变量被closure捕获时，每次迭代使用新的frame，closure各自捕获当次迭代的绑定；
+        否则所有迭代共用一个frame。for/each相同。
+        """
         pred = ast.value[1]
-        if pred.suffix != ':':
-            raise RuntimeError("No ':' after while predication")
-        for item in ast.value[1:]:
-            eval(item)
-    def eval_code_for(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid for expression")
-        ast.special = FOR_LIST
+        body = ast.value[2:]
+        if ast.captured:
+            while True:
+                frame = mkframe(ast)
+                if not (yield from test(pred)):
+                    closeframe(frame.id)
+                    return False
+                broken = yield from iterate(frame, body)
+                closeframe(frame.id)
+                if broken:
+                    return True
+        frame = enter(ast)
+        broken = False
+        while (yield from test(pred)):
+            try:
+                for item in body:
+                    if item.tag in leaf_tags:
+                        immediate(item)
+                    else:
+                        yield item
+            except ContinueLoop:
+                unwind(frame)
+            except BreakLoop:
+                unwind(frame)
+                broken = True
+                break
+        leave(ast, frame)
+        return broken
+    def loop_for(ast):
+        """
+        返回循环是否被break。
+        循环变量在同一个frame中原地重新绑定，range不生成List。
+        """
         pred = ast.value[1]
-        if pred.suffix != ':':
-            raise RuntimeError("No ':' after for parameter list")
-        if pred.tag != LIST_LIST:
-            raise RuntimeError("Invalid for parameter list")
-        if len(pred.value) not in (3, 4):
-            raise RuntimeError("Invalid for parameter list")
-        if pred.value[0].tag != IDENTIFIER:
-            raise RuntimeError("Invalid for parameter")
-        pred.addvartoscope(pred.value[0].value)
+        body = ast.value[2:]
+        name = pred.value[0].value
+        bounds = []
         for item in pred.value[1:]:
-            eval(item)
-        for item in ast.value[2:]:
-            eval(item)
-    def eval_code_each(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid each expression")
-        ast.special = EACH_LIST
+            bounds.append(first((yield item)))
+        numbers = for_range(*bounds)
+        if ast.captured:
+            for n in numbers:
+                frame = mkframe(ast)
+                frame.vars = {name: n}
+                broken = yield from iterate(frame, body)
+                closeframe(frame.id)
+                if broken:
+                    return True
+            return False
+        frame = enter(ast)
+        if frame.vars is None:
+            frame.vars = {}
+        vars = frame.vars
+        broken = False
+        for n in numbers:
+            vars[name] = n
+            try:
+                for item in body:
+                    if item.tag in leaf_tags:
+                        immediate(item)
+                    else:
+                        yield item
+            except ContinueLoop:
+                unwind(frame)
+            except BreakLoop:
+                unwind(frame)
+                broken = True
+                break
+        leave(ast, frame)
+        return broken
+    def loop_each(ast):
+        """返回循环是否被break，迭代的内容见each_items"""
         pred = ast.value[1]
-        if pred.suffix != ':':
-            raise RuntimeError("No ':' after each parameter list")
-        if pred.tag != LIST_LIST:
-            raise RuntimeError("Invalid each parameter list")
-        if len(pred.value) < 2:
-            raise RuntimeError("Invalid each parameter list")
-        for item in pred.value[:-1]:
-            eval_destructure(item)
-        eval(pred.value[-1])
-        for item in ast.value[2:]:
-            eval(item)
+        body = ast.value[2:]
+        targets = pred.value[:-1]
+        if len(targets) > 2:
+            error(f"Too many each bindings: {pred}")
+        items = each_items(first((yield pred.value[-1])), len(targets))
+        if ast.captured:
+            for item in items:
+                frame = mkframe(ast)
+                bind_each(targets, item)
+                broken = yield from iterate(frame, body)
+                closeframe(frame.id)
+                if broken:
+                    return True
+            return False
+        frame = enter(ast)
+        broken = False
+        for item in items:
+            bind_each(targets, item)
+            try:
+                for expr in body:
+                    if expr.tag in leaf_tags:
+                        immediate(expr)
+                    else:
+                        yield expr
+            except ContinueLoop:
+                unwind(frame)
+            except BreakLoop:
+                unwind(frame)
+                broken = True
+                break
+        leave(ast, frame)
+        return broken
+    def bind_each(targets, item):
+        if len(targets) == 1:
+            eval_destructure(targets[0], item)
+        else:
+            eval_destructure(targets[0], item[0])
+            eval_destructure(targets[1], item[1])
+    def eval_code_loop(ast):
+        yield from loops[ast.special](ast)
     def eval_code_break(ast):
-        ast.special = BREAK_LIST
+        raise BreakLoop()
     def eval_code_continue(ast):
-        ast.special = CONTINUE_LIST
+        raise ContinueLoop()
     def eval_code_fn(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid fn expression")
-        ast.special = FN_LIST
-        ai = 1
+        closure = Closure(ast)
+        capture(closure)
         if ast.value[1].tag == IDENTIFIER:
-            ast.addvartoscope(ast.value[1].value)
-            ai = 2
-        arglist = ast.value[ai]
-        if arglist.suffix != ':':
-            raise RuntimeError("No ':' after fn parameter list")
-        if arglist.tag != LIST_LIST:
-            raise RuntimeError("Invalid fn parameter list")
-        for arg in arglist.value:
-            if arg.tag == IDENTIFIER:
-                arg.addvartoscope(arg.value)
-            elif arg.tag == VARARG:
-                arg.addvartoscope('...')
-            else:
-                raise RuntimeError(f"Invalid fn argument: {arg}")
-        for item in ast.value[ai+1:]:
-            eval(item)
-    def eval_code_let(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid let expression")
-        ast.special = LET_LIST
-        for item in ast.value[1:-1]:
-            eval_destructure(item)
-        eval(ast.value[-1])
-    def eval_code_var(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid var expression")
-        ast.special = VAR_LIST
-        for item in ast.value[1:-1]:
-            eval_destructure(item)
-        eval(ast.value[-1])
+            setvar(ast.value[1].value, closure)
+        return closure
+    def eval_bindings(ast):
+        """let/var"""
+        expr = ast.value[-1]
+        return bind_values(ast, immediate(expr) if expr.tag in leaf_tags else (yield expr))
+    def bind_values(ast, value):
+        """let/var: 多个绑定对应(values ...)的多个值"""
+        targets = ast.value[1:-1]
+        if value.__class__ is Values:
+            values = value.value
+            if len(values) != len(targets):
+                error(f"{len(values)} values for {len(targets)} bindings: {ast}")
+            for target, v in zip(targets, values):
+                eval_destructure(target, v)
+            return values[0]
+        if len(targets) != 1:
+            error(f"1 value for {len(targets)} bindings: {ast}")
+        eval_destructure(targets[0], value)
+        return value
     def eval_code_set(ast):
-        if len(ast.value) != 3:
-            raise RuntimeError("Invalid set expression")
-        ast.special = SET_LIST
-        for item in ast.value[1:]:
-            eval(item)
+        target = ast.value[1]
+        if target.tag != IDENTIFIER:
+            error(f"Invalid set target {target}")
+        expr = ast.value[2]
+        value = first(immediate(expr) if expr.tag in leaf_tags else (yield expr))
+        getvar(target.value).set(value)
+        return value
     def eval_code_import(ast):
         if len(ast.value) < 3:
             raise RuntimeError("Invalid import expression")
@@ -1626,33 +3980,21 @@ def interpret(code):
         for item in ast.value[1:-1]:
             eval_destructure(item)
         eval(ast.value[-1])
+    def eval_code_dot(ast):
+        value = first((yield ast.value[1]))
+        if ast.path is not None:
+            return getpath(ast, value, ast.path)
+        keys = []
+        for k in ast.value[2:]:
+            keys.append(first((yield k)))
+        return getpath(None, value, keys)
+
     def eval_code_pass(ast):
         ast.special = PASS_LIST
         for item in ast.value[1:]:
             eval(item)
-    def eval_code_and(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid and expression")
-        ast.special = AND_LIST
-        for item in ast.value[1:]:
-            eval(item)
-    def eval_code_or(ast):
-        if len(ast.value) < 3:
-            raise RuntimeError("Invalid or expression")
-        ast.special = AND_LIST
-        for item in ast.value[1:]:
-            eval(item)
-    def eval_code_not(ast):
-        if len(ast.value) != 2:
-            raise RuntimeError("Invalid not expression")
-        ast.special = NOT_LIST
-        eval(ast.value[1])
     def eval_code_question(ast):
-        if len(ast.value) != 4:
-            raise RuntimeError("Invalid ? expression")
-        ast.special = QUESTION_LIST
-        for item in ast.value[1:]:
-            eval(item)
+        return (yield ast.value[2] if (yield from test(ast.value[1])) else ast.value[3])
     def eval_code_try(ast):
         raise RuntimeError("not support try")
     def eval_code_catch(ast):
@@ -1663,30 +4005,35 @@ def interpret(code):
         raise RuntimeError("not support throw")
 
     specials = {
+        '.': eval_code_dot,
         'do': eval_code_do,
+        'if': eval_code_if,
+        'while': eval_code_loop,
+        'for': eval_code_loop,
+        'each': eval_code_loop,
+        'let': eval_bindings,
+        'var': eval_bindings,
+        'set': eval_code_set,
+        'and': test,
+        'or': test,
+        'not': test,
+        '?': eval_code_question,
+    }
+
+    # 不求值任意长的子节点的special，不是生成器，直接求值；match等在内部同步求值
+    immediates = {
         'match': eval_code_match,
         'case': eval_code_case,
         'caseif': eval_code_caseif,
         'cases': eval_code_cases,
         'default': eval_code_default,
-        'if': eval_code_if,
         'elif': eval_code_elif,
         'else': eval_code_else,
-        'while': eval_code_while,
-        'for': eval_code_for,
-        'each': eval_code_each,
         'break': eval_code_break,
         'continue': eval_code_continue,
         'fn': eval_code_fn,
-        'let': eval_code_let,
-        'var': eval_code_var,
-        'set': eval_code_set,
         'import': eval_code_import,
         'pass': eval_code_pass,
-        'and': eval_code_and,
-        'or': eval_code_or,
-        'not': eval_code_not,
-        '?': eval_code_question,
         'try': eval_code_try,
         'catch': eval_code_catch,
         'finally': eval_code_finally,
@@ -1694,107 +4041,1315 @@ def interpret(code):
     }
 
     def eval_code(ast):
-        if not ast.value:
-            raise RuntimeError("Invalid empty code list")
         op = ast.value[0]
-        if op.tag == IDENTIFIER and op.value in specials:
-                return specials[op.value](ast)
-        else:
-            op = eval(ast.value[0])
-            args = []
-            for item in ast.value[1:]:
-                args.append(eval(item))
-            if op.tag not in (CLOSURE, PYFUNCTION):
-                raise RuntimeError(f'Invalid operator {op}')
-            if op.tag == CLOSURE:
-                frame = mkframe(op.value)
-                frame.upvars = op.upvalues
-                argv = frame.ast.argv
-                if argv and argv[-1] == '...':
-                    if len(args) < len(argv)-1:
-                        raise RuntimeError(f"{op.value}: Too less arguments")
-                    frame.vars = {argv[i]: args[i] for i in range(len(argv)-1)}
-                    frame.vars['...'] = args[len(argv)-1:]
-                elif len(argv) != len(args):
-                    raise RuntimeError(f"{op.value}: argument mismatch")
+        op = immediate(op) if op.tag in leaf_tags else (yield op)
+        if op.__class__ is Closure and op.value.nfixed is not None:
+            return (yield from call_variadic(op, ast.value))
+        args = []
+        for item in ast.value[1:]:
+            value = immediate(item) if item.tag in leaf_tags else (yield item)
+            if value.__class__ is Values:
+                # 多个值展开为多个参数
+                args.extend(value.value)
+            else:
+                args.append(value)
+        if op.__class__ is PyFunction and id(op) not in suspendable:
+            value = op.value(args)
+            if awaiting and inspect.isawaitable(value):
+                value = yield value
+            return value
+        return (yield from call(op, args))
+
+    def call(op, args):
+        if op.__class__ is PyFunction:
+            # map/filter的函数参数是closure时也由生成器求值，其他内置函数直接执行
+            if op is map_fn:
+                return (yield from call_map(args))
+            if op is filter_fn:
+                return (yield from call_filter(args))
+            if awaiting and (op is pmap_fn or op is peach_fn):
+                # 宿主函数的调用一起等待，不使用线程池
+                value = yield from call_map(args[:2])
+                return value if op is pmap_fn else None
+            value = op.value(args)
+            if awaiting and inspect.isawaitable(value):
+                value = yield value
+            return value
+        elif op.__class__ is not Closure:
+            raise RuntimeError(f'Invalid operator {display(op, True)}')
+        if op.value.tag == HASH_LIST:
+            return (yield from call_hash(op, args))
+        n = op.value.nfixed
+        if n is not None:
+            if len(args) < n:
+                raise RuntimeError(f"{op.value}: Too less arguments")
+            return (yield from call_closure(op, args[:n], args[n:]))
+        elif len(op.value.argv) != len(args):
+            raise RuntimeError(f"{op.value}: argument mismatch")
+        return (yield from call_closure(op, args))
+
+    def call_variadic(op, items):
+        """
+        变参函数的调用。参数求值时直接分成固定参数和...两部分，不再切片复制；
+        最后一个参数是多个值(比如转发调用者的...)并且固定参数已满时，
+        直接共用它的list作为...，多层转发不复制。
+        """
+        n = op.value.nfixed
+        args = []
+        rest = []
+        last = len(items) - 1
+        for i in range(1, len(items)):
+            item = items[i]
+            value = immediate(item) if item.tag in leaf_tags else (yield item)
+            if value.__class__ is not Values:
+                if len(args) < n:
+                    args.append(value)
                 else:
-                    frame.vars = {argv[i]: args[i] for i in range(len(argv))}
-                value = None
-                bodybegin = 3 if frame.ast.value[1].tag == IDENTIFIER else 2
-                for expr in frame.ast.value[bodybegin:]:
-                    value = eval(expr)
+                    rest.append(value)
+                continue
+            values = value.value
+            if len(args) < n:
+                k = n - len(args)
+                args.extend(values[:k])
+                values = values[k:]
+            if i == last and not rest:
+                rest = values
+            else:
+                rest.extend(values)
+        if len(args) < n:
+            raise RuntimeError(f"{op.value}: Too less arguments")
+        return (yield from call_closure(op, args, rest))
+
+    def call_closure(op, args, rest=None):
+        """args是固定参数，rest是...的多个值，...直接绑定为Values，不生成List"""
+        if op.value.lazy is not None:
+            parse_lazy(op.value)
+        frame = mkframe(op.value)
+        frame.upvars = op.upvalues
+        argv = frame.ast.argv
+        vars = frame.vars
+        if vars is None:
+            frame.vars = vars = {}
+        vars.update(zip(argv, args))
+        if rest is not None:
+            frame.vars['...'] = Values(rest)
+        value = None
+        bodybegin = 3 if frame.ast.value[1].tag == IDENTIFIER else 2
+        for expr in frame.ast.value[bodybegin:]:
+            value = immediate(expr) if expr.tag in leaf_tags else (yield expr)
+        closeframe(frame.id)
+        return value
+
+    # 当前hash函数调用的参数，hash函数体中的$N直接按序号读取
+    hashargs = None
+
+    def call_hash(op, args):
+        """
+        hash函数的调用。参数个数parse时已确定，参数列表直接作为$N的slot数组。
+        hash函数体内没有其他绑定、参数也没有被内部closure捕获时，
+        不创建和注册frame，只在有捕获变量时压入closure共享的frame。
+        """
+        nonlocal hashargs
+        fn = op.value
+        if len(args) != len(fn.argv):
+            raise RuntimeError(f"{fn}: argument mismatch")
+        if fn.fastcall is None:
+            fn.fastcall = not hash_captured(fn)
+        saved = hashargs
+        hashargs = args
+        try:
+            if not fn.fastcall:
+                frame = mkframe(fn)
+                frame.upvars = op.upvalues
+                if frame.vars is None:
+                    frame.vars = {}
+                frame.vars.update(zip(fn.argv, args))
+                value = yield fn.value[0]
                 closeframe(frame.id)
                 return value
-            else:
-                return op.value(args)
+            if op.frame is None:
+                return (yield fn.value[0])
+            depth = len(stack)
+            stack.append(op.frame)
+            try:
+                return (yield fn.value[0])
+            finally:
+                if len(stack) > depth + 1:
+                    closeframe(stack[depth+1].id)
+                del stack[depth:]
+        finally:
+            # 函数体求值期间的hash调用都在它之前结束，hashargs按后进先出恢复
+            hashargs = saved
+
+    def hash_captured(fn):
+        """hash函数是否需要真正的frame：有$N之外的绑定，或者变量被内部的closure捕获"""
+        if fn.boundvars and len(fn.boundvars) != len(fn.argv):
+            return True
+        nodes = [fn.value[0]]
+        while nodes:
+            node = nodes.pop()
+            if node.upvars and fn in node.upvars.values():
+                return True
+            if isinstance(node.value, list):
+                nodes.extend(node.value)
+        return False
+
+    def call_map(args):
+        if len(args) == 2 and args[0].__class__ is PyFunction and args[1].__class__ is List:
+            f = args[0].value
+            if awaiting and f in hosts:
+                # map宿主函数时先发起所有调用，返回的awaitable一起等待，I/O互相重叠
+                items = [f([item]) for item in args[1].value]
+                pending = [i for i, item in enumerate(items) if inspect.isawaitable(item)]
+                if pending:
+                    values = yield gather([items[i] for i in pending])
+                    for i, item in zip(pending, values):
+                        items[i] = item
+                return List(items)
+        if len(args) != 2 or args[0].__class__ is not Closure:
+            return map_fn.value(args)
+        f, seq = args
+        result = []
+        if seq.__class__ is List:
+            for item in seq.value:
+                result.append((yield from call(f, [item])))
+        elif isinstance(seq, Dict):
+            for k, v in seq.value.items():
+                result.append((yield from call(f, [plain_key(k), v])))
+        else:
+            return map_fn.value(args)
+        return List(result)
+
+    def call_filter(args):
+        if len(args) != 2 or args[0].__class__ is not Closure:
+            return filter_fn.value(args)
+        f, seq = args
+        if seq.__class__ is List:
+            result = []
+            for item in seq.value:
+                if (yield from call(f, [item])):
+                    result.append(item)
+            return List(result)
+        elif isinstance(seq, Dict):
+            result = {}
+            for k, v in seq.value.items():
+                if (yield from call(f, [plain_key(k), v])):
+                    result[k] = v
+            return Dict(result)
+        return filter_fn.value(args)
+
+    loops = {
+        WHILE_LIST: loop_while,
+        FOR_LIST: loop_for,
+        EACH_LIST: loop_each,
+    }
+
+    def eqconst(pred):
+        """谓词是(= 变量 常量)或(= 常量 变量)时，返回(变量, 常量)"""
+        if (pred.tag != CODE_LIST or len(pred.value) != 3 or
+                pred.value[0].tag != IDENTIFIER or pred.value[0].value != '='):
+            return None
+        a, b = pred.value[1:]
+        if a.tag in const_tags:
+            a, b = b, a
+        if a.tag in (IDENTIFIER, MULTI_IDENTIFIER) and b.tag in const_tags:
+            return a, eval(b)
+        return None
+
+    def compile_cond(ast):
+        """
+        把if/elif/else链编译为(谓词, 分支)数组。
+        如果所有谓词都是同一个变量和常量的相等比较，再生成常量到分支的跳转表。
+        """
+        ast.branches = [(item.value[1], item) for item in ast.value
+                        if item.special != ELSE_LIST]
+        last = ast.value[-1]
+        ast.otherwise = last if last.special == ELSE_LIST else None
+        ast.subject = ast.jumptable = None
+        if len(ast.branches) < jumptable_min:
+            return
+        table = {}
+        for pred, branch in ast.branches:
+            match = eqconst(pred)
+            if not match:
+                return
+            subject, const = match
+            if ast.subject is None:
+                ast.subject = subject
+            elif (subject.tag, subject.value) != (ast.subject.tag, ast.subject.value):
+                ast.subject = None
+                return
+            entry = table.get(const)
+            if entry is None:
+                table[const] = (const, branch)
+            elif not equal(entry[0], const):
+                # 1、1.0和true在Python dict中是同一个key，不能用跳转表区分
+                ast.subject = None
+                return
+        ast.jumptable = table
 
     def eval_cond(ast):
-        pass
+        first = ast.value[0]
+        if first.special in loops:
+            # while/for/each + else：循环没有被break时执行else
+            if not (yield from loops[first.special](first)):
+                other = ast.value[1]
+                yield from eval_scope(other, other.value[1:])
+            return None
+        if not hasattr(ast, 'branches'):
+            compile_cond(ast)
+        if ast.jumptable is not None and getvar('=').get() is builtin_eq_fn:
+            value = yield ast.subject
+            entry = ast.jumptable.get(value) if tagof(value) in const_tags else None
+            if entry and equal(value, entry[0]):
+                branch = entry[1]
+                return (yield from eval_scope(branch, branch.value[2:]))
+        else:
+            for pred, branch in ast.branches:
+                if (yield from test(pred)):
+                    return (yield from eval_scope(branch, branch.value[2:]))
+        if ast.otherwise:
+            return (yield from eval_scope(ast.otherwise, ast.otherwise.value[1:]))
+        return None
 
     def eval_hash(ast):
-        pass
+        closure = Closure(ast)
+        capture(closure)
+        if ast.upvars:
+            # 所有调用共享一个frame，只用来查找捕获变量
+            closure.frame = Frame(ast)
+            closure.frame.upvars = closure.upvalues
+        return closure
 
     def eval_list(ast):
-        value = [eval(v) for v in ast.value]
+        value = []
+        for v in ast.value:
+            v = yield v
+            if v.__class__ is Values:
+                value.extend(v.value)
+            else:
+                value.append(v)
         return List(value)
 
     def eval_dict(ast):
-        value = {eval(v.value[0]): eval(v.value[1]) for v in ast.value}
+        if ast.shape is not None:
+            slots = []
+            for v in ast.value:
+                slots.append(first((yield v.value[1])))
+            return Record(ast.shape, slots)
+        value = {}
+        for v in ast.value:
+            key = first((yield v.value[0]))
+            if key.__class__ is bool or key.__class__ is float:
+                key = dict_key(key)
+            value[key] = first((yield v.value[1]))
         return Dict(value)
 
-    def eval(ast):
-        if ast.tag == NONE:
-            return none
-        elif ast.tag == TRUE:
-            return true
-        elif ast.tag == FALSE:
-            return false
-        elif ast.tag in (INTEGER, FLOAT):
-            return Value(ast.tag, ast.value)
-        elif ast.tag in (SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING):
-            return Value(STRING, ast.value)
-        elif ast.tag == VARARG:
-            return Value(VARARG)
-        elif ast.tag == IDENTIFIER:
-            var = getvar(ast.value)
-            return var.get()
-        elif ast.tag == MULTI_IDENTIFIER:
-            ids = ast.value.split('.')
-            var = getvar(ids[0])
-            for key in ids[1:]:
-                var = var.get().get(key)
-            return var.get()
-        elif ast.tag == AND_REMINDER:
+    def stepper(ast):
+        """ast对应的生成器函数，None表示没有子节点要求值，用immediate直接求值"""
+        tag = ast.tag
+        if tag == CODE_LIST:
+            if not ast.value:
+                return None
+            op = ast.value[0]
+            if op.tag == IDENTIFIER:
+                name = op.value
+                if name in specials:
+                    return specials[name]
+                if name in immediates:
+                    return None
+            return eval_code
+        elif tag == COND_LIST:
+            return eval_cond
+        elif tag == LIST_LIST:
+            return eval_list
+        elif tag == DICT_LIST:
+            return eval_dict
+        return None
+
+    def immediate(ast):
+        tag = ast.tag
+        if tag == IDENTIFIER:
+            if ast.slot is not None:
+                return hashargs[ast.slot]
+            return getvalue(ast.value)
+        elif tag in value_tags:
+            return ast.value
+        elif tag == NONE:
+            return None
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        elif tag == INTERN_STRING:
+            return intern_string(ast.value)
+        elif tag == VARARG:
+            return getvalue('...')
+        elif tag == MULTI_IDENTIFIER:
+            return getpath(ast, immediate(ast.head), ast.path)
+        elif tag == AND_REMINDER:
             pass
-        elif ast.tag == AT_WHOLE:
+        elif tag == AT_WHOLE:
             pass
-        elif ast.tag == COND_LIST:
-            return eval_cond(ast)
-        elif ast.tag == CODE_LIST:
-            return eval_code(ast)
-        elif ast.tag == HASH_LIST:
+        elif tag == CODE_LIST:
+            if not ast.value:
+                raise RuntimeError("Invalid empty code list")
+            return immediates[ast.value[0].value](ast)
+        elif tag == HASH_LIST:
             return eval_hash(ast)
-        elif ast.tag == LIST_LIST:
-            return eval_list(ast)
-        elif ast.tag == DICT_LIST:
-            return eval_dict(ast)
         else:
             error(f"invalid ast: {ast}")
+
+    def execute(gen, budget=None, suspend=False):
+        """
+        执行生成器gen：栈顶的生成器yield出的子节点有stepper时压栈，否则直接求值，
+        结果send回去，异常throw回去。生成器结束时的返回值是gen的结果。
+        budget不为None时每求值budget个节点yield一次(yield None)，调用者用next恢复。
+        宿主函数返回的awaitable在suspend为真时yield给调用者，等待后把结果send回来。
+        """
+        left = budget
+        gens = [gen]
+        value = None
+        exc = None
+        while True:
+            gen = gens[-1]
+            try:
+                if exc is not None:
+                    e, exc = exc, None
+                    node = gen.throw(e)
+                else:
+                    node = gen.send(value)
+            except StopIteration as stop:
+                gens.pop()
+                value = stop.value
+                if not gens:
+                    return value
+                continue
+            except Exception as e:
+                gens.pop()
+                if not gens:
+                    raise
+                exc = e
+                continue
+            if node.__class__ is not AstNode:
+                if suspend:
+                    try:
+                        value = yield node
+                    except Exception as e:
+                        exc = e
+                else:
+                    value = node
+                continue
+            if left is not None:
+                left -= 1
+                if not left:
+                    left = budget
+                    yield
+            make = stepper(node)
+            if make is None:
+                value = None
+                try:
+                    value = immediate(node)
+                except Exception as e:
+                    exc = e
+            else:
+                gens.append(make(node))
+                value = None
+
+    def evaluate(gen):
+        """执行生成器gen到结束，返回它的结果"""
+        try:
+            next(execute(gen))
+        except StopIteration as stop:
+            return stop.value
+
+    def eval(ast):
+        make = stepper(ast)
+        if make is None:
+            return immediate(ast)
+        return evaluate(make(ast))
+
+    if budget is not None:
+        return execute(eval_body([root]), budget, awaiting)
     return eval(root)
 
 
+async def interpret_async(code, passes=(), lazy=False, env=None, budget=10000):
+    """
+    在asyncio中执行fry程序，返回程序的结果。env中的宿主函数可以返回awaitable，
+    程序在这里挂起，事件循环等待结果期间执行其他协程和fry程序，多个程序的I/O互相重叠；
+    map宿主函数时各次调用同时等待。
+    和Scheduler一样，程序是interpret返回的可以挂起的执行，在事件循环的线程中运行，
+    每执行budget步让出一次，计算很多的程序也不会阻塞其他协程，取消时从挂起处结束。
+    """
+    program = interpret(code, passes, lazy, budget, env)
+    value = None
+    exc = None
+    try:
+        while True:
+            if exc is not None:
+                e, exc = exc, None
+                item = program.throw(e)
+            else:
+                item = program.send(value)
+            value = None
+            if item is None:
+                await asyncio.sleep(0)
+                continue
+            try:
+                value = await item
+            except Exception as e:
+                exc = e
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        program.close()
+
+async def gather(awaitables):
+    return await asyncio.gather(*awaitables)
+
+
+class Task:
+    """Scheduler中的一个fry程序，program是interpret返回的可以挂起的执行，第一次调度时才创建"""
+    def __init__(self, code, weight, passes, lazy):
+        self.code = code
+        self.weight = weight       # 每个时间片执行weight * budget步
+        self.passes = passes
+        self.lazy = lazy
+        self.result = None
+        self.error = None          # 程序抛出的异常
+        self.done = False
+        self.cancelled = False
+        self.slices = 0            # 已经执行的时间片数
+        self.program = None
+
+
+class Scheduler:
+    """
+    在一个线程中轮流执行多个fry程序：每个程序执行一个时间片(budget步乘以权重)后挂起，
+    排到就绪队列末尾，按加权轮转调度，长时间运行的程序不会饿死其他程序。
+    程序的结果和异常保存在spawn返回的Task中。
+    """
+    def __init__(self, budget=10000):
+        self.budget = budget
+        self.ready = collections.deque()
+
+    def spawn(self, code, weight=1, passes=(), lazy=False):
+        task = Task(code, weight, passes, lazy)
+        self.ready.append(task)
+        return task
+
+    def step(self):
+        """执行就绪队列中下一个程序的一个时间片，返回是否还有程序没有结束"""
+        task = self.ready.popleft()
+        try:
+            if task.program is None:
+                task.program = interpret(task.code, task.passes, task.lazy,
+                                         task.weight * self.budget)
+            next(task.program)
+        except StopIteration as stop:
+            task.result = stop.value
+            task.done = True
+        except Exception as e:
+            task.error = e
+            task.done = True
+        else:
+            task.slices += 1
+            self.ready.append(task)
+        return bool(self.ready)
+
+    def run(self):
+        """执行到所有程序结束"""
+        while self.ready:
+            self.step()
+
+    def cancel(self, task):
+        """取消没有结束的程序，挂起的程序不再恢复"""
+        if task.done:
+            return
+        self.ready.remove(task)
+        task.cancelled = True
+        task.done = True
+        if task.program is not None:
+            task.program.close()
+
+
+def splat(args):
+    """参数中的多个值展开为多个参数"""
+    for arg in args:
+        if arg.__class__ is Values:
+            break
+    else:
+        return args
+    result = []
+    for arg in args:
+        if arg.__class__ is Values:
+            result.extend(arg.value)
+        else:
+            result.append(arg)
+    return result
+
+def call_value(op, args):
+    """转换后的代码中函数都是PyFunction，参数约定相同"""
+    if op.__class__ is not PyFunction:
+        raise RuntimeError(f'Invalid operator {display(op, True)}')
+    return op.value(args)
+
+def mismatch(fn, args):
+    raise RuntimeError(f"{fn}: argument mismatch")
+
+def tooless(fn, args):
+    raise RuntimeError(f"{fn}: Too less arguments")
+
+def values_of(value, n, form):
+    """let/var的多个绑定对应(values ...)的多个值"""
+    if value.__class__ is Values:
+        if len(value.value) != n:
+            raise RuntimeError(f"{len(value.value)} values for {n} bindings: {form}")
+        return value.value
+    if n != 1:
+        raise RuntimeError(f"1 value for {n} bindings: {form}")
+    return [value]
+
+def list_items(value, n, pattern):
+    if value.__class__ is not List:
+        raise RuntimeError(f"Can not destructure {display(value, True)} as list")
+    if len(value.value) < n:
+        raise RuntimeError(f"Not enough items to destructure {pattern}")
+    return value.value
+
+def dict_check(value, pattern):
+    if not isinstance(value, Dict):
+        raise RuntimeError(f"Can not destructure {display(value, True)} as dict")
+
+def dict_get(value, key, pattern):
+    if value.__class__ is Record:
+        offset = value.shape.offsets.get(key)
+        item = missing if offset is None else value.slots[offset]
+    else:
+        item = value.value.get(dict_key(key), missing)
+    if item is missing:
+        raise RuntimeError(f"No key {key} to destructure {pattern}")
+    return item
+
+def dict_rest(value, keys):
+    """dict解构中&rest绑定的其余key"""
+    if value.__class__ is Record:
+        rest = [i for i, key in enumerate(value.shape.keys) if key not in keys]
+        return Record(Shape.of(value.shape.keys[i] for i in rest), [value.slots[i] for i in rest])
+    keys = set(dict_key(k) for k in keys)
+    return Dict({k: v for k, v in value.value.items() if k not in keys})
+
+# 转换后的代码使用的内置函数，map/filter的函数参数也是PyFunction
+compiled_builtins = builtin_functions(call_value)
+
+def binary(name, op):
+    """两个参数的算术/比较内置函数：都是数字时直接计算，否则交给内置函数处理(字符串、报错)"""
+    slow = compiled_builtins[name].value
+    def fast(a, b):
+        ca = a.__class__
+        cb = b.__class__
+        if (ca is int or ca is float) and (cb is int or cb is float):
+            return op(a, b)
+        return slow([a, b])
+    return fast
+
+def not_equal(a, b):
+    return not equal(a, b)
+
+binary_builtins = {
+    '+': binary('+', operator.add),
+    '-': binary('-', operator.sub),
+    '*': binary('*', operator.mul),
+    '<': binary('<', operator.lt),
+    '>': binary('>', operator.gt),
+    '<=': binary('<=', operator.le),
+    '>=': binary('>=', operator.ge),
+    '=': equal,
+    '!=': not_equal,
+}
+
+# 转换后的代码可以使用的运行时函数和类型
+transpile_runtime = {
+    'List': List,
+    'Dict': Dict,
+    'Record': Record,
+    'Values': Values,
+    'PyFunction': PyFunction,
+    'first': first,
+    'getpath': getpath,
+    'splat': splat,
+    'call_value': call_value,
+    'mismatch': mismatch,
+    'tooless': tooless,
+    'values_of': values_of,
+    'list_items': list_items,
+    'dict_check': dict_check,
+    'dict_get': dict_get,
+    'dict_rest': dict_rest,
+    'dict_key': dict_key,
+    'for_range': for_range,
+    'each_items': each_items,
+}
+
+# 在Python代码中不需要再次求值的表达式：字面量、临时变量和常量
+stable_expr = re.compile(r'_[tk]\d+|None|True|False|-?\d[\d.e+-]*|\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"')
+
+# 变量的Python名字
+variable_expr = re.compile(r'v\d+_\w*(?:\[0\])?')
+
+
+class Untranspilable(RuntimeError):
+    """程序中有transpile不支持的表达式(match、import等)，run改用interpret执行"""
+
+
+class Transpiler:
+    """
+    把parse过的ast转换为Python源代码。
+    fn/hash函数转换为def，参数约定和PyFunction相同(一个参数list)；
+    变量名加上绑定作用域的序号，块作用域不会冲突，closure直接使用Python的闭包，
+    set外层函数的变量时声明nonlocal。
+    Python闭包按变量捕获，循环中被closure捕获的块作用域变量改为每次迭代新建的单元素list，
+    def时作为默认参数传入，closure各自捕获当次迭代的绑定，见iscell。
+    每个fry表达式转换为一个Python表达式，if/循环/let等需要语句的地方先输出语句，
+    结果放到临时变量中。
+    """
+    def __init__(self, lineof):
+        self.lineof = lineof
+        self.lines = []      # [缩进, 代码, fry行号]
+        self.indent = 0
+        self.line = 0
+        self.consts = {}     # name -> 对象
+        self.constnames = {} # id(对象) -> name
+        self.scopes = {}     # id(作用域) -> 序号
+        self.cells = {}      # id(作用域) -> 变量是否放在单元素list中
+        self.ntemp = 0
+        self.nfn = 0
+        self.defs = [[None, set(), 0]] # 正在转换的函数: [fn ast, nonlocal变量, nonlocal插入位置]
+        self.loops = []      # 当前函数中的循环，元素是break时要设置的标志变量
+        self.forms = {
+            'do': self.code_do,
+            'if': self.code_if,
+            'while': self.code_loop,
+            'for': self.code_loop,
+            'each': self.code_loop,
+            'break': self.code_break,
+            'continue': self.code_continue,
+            'fn': self.code_fn,
+            'let': self.code_let,
+            'var': self.code_let,
+            'set': self.code_set,
+            'pass': self.code_pass,
+            'and': self.code_bool,
+            'or': self.code_bool,
+            'not': self.code_bool,
+            '?': self.code_question,
+            '.': self.code_dot,
+        }
+
+    def transpile(self, root):
+        """返回(Python源代码, Python行号对应的fry行号)"""
+        self.emit('def __fry__():')
+        self.indent += 1
+        value = self.expr(root)
+        self.line = 0
+        self.emit(f'return {value}')
+        self.indent -= 1
+        source = '\n'.join('    ' * indent + code for indent, code, _ in self.lines) + '\n'
+        return source, [line for _, _, line in self.lines]
+
+    def emit(self, code):
+        self.lines.append([self.indent, code, self.line])
+
+    def temp(self):
+        self.ntemp += 1
+        return f'_t{self.ntemp}'
+
+    def const(self, value):
+        name = self.constnames.get(id(value))
+        if name is None:
+            name = f'_k{len(self.consts)}'
+            self.consts[name] = value
+            self.constnames[id(value)] = name
+        return name
+
+    def pyname(self, name, scope):
+        n = self.scopes.get(id(scope))
+        if n is None:
+            n = self.scopes[id(scope)] = len(self.scopes)
+        safe = ''.join(ch if ch.isascii() and (ch.isalnum() or ch == '_') else f'_{ord(ch):x}_'
+                       for ch in name)
+        return f'v{n}_{safe}'
+
+    def var(self, name, scope):
+        var = self.pyname(name, scope)
+        return f'{var}[0]' if self.iscell(scope) else var
+
+    def iscell(self, scope):
+        """作用域的变量被closure捕获，并且作用域在当前函数的循环之中(或者就是循环)"""
+        cell = self.cells.get(id(scope))
+        if cell is None:
+            cell = False
+            if scope.captured and not scope.isfn():
+                node = scope
+                while node is not None and not node.isfn():
+                    if node.special in (WHILE_LIST, FOR_LIST, EACH_LIST):
+                        cell = True
+                        break
+                    node = node.parent
+            self.cells[id(scope)] = cell
+        return cell
+
+    def newcells(self, loop):
+        """每次迭代开始时为循环中(不包括内层循环和函数)的单元素list变量新建list"""
+        nodes = [loop]
+        while nodes:
+            node = nodes.pop()
+            if node.boundvars and self.iscell(node):
+                for name in sorted(node.boundvars):
+                    self.emit(f'{self.pyname(name, node)} = [None]')
+            if isinstance(node.value, list):
+                nodes.extend(child for child in reversed(node.value)
+                             if not child.isfn() and child.special not in (WHILE_LIST, FOR_LIST, EACH_LIST))
+
+    def assign(self, name, scope, value):
+        """绑定/修改变量，变量属于外层函数时声明nonlocal"""
+        if scope is None:
+            raise RuntimeError(f"Can not set builtin {name}")
+        var = self.var(name, scope)
+        if not self.iscell(scope):
+            fn = scope
+            while not fn.isfn():
+                fn = fn.parent
+            if fn is not self.defs[-1][0]:
+                self.defs[-1][1].add(var)
+        self.emit(f'{var} = {value}')
+        return var
+
+    def stable(self, value):
+        """需要多次使用的表达式先保存到临时变量"""
+        if stable_expr.fullmatch(value):
+            return value
+        t = self.temp()
+        self.emit(f'{t} = {value}')
+        return t
+
+    def capture(self, fn, *args):
+        """
+        转换到单独的代码行中，返回(代码行, 表达式)，用于判断是否需要语句。
+        代码行的缩进是相对的，由replay按输出位置的缩进输出。
+        """
+        lines, indent = self.lines, self.indent
+        self.lines, self.indent = [], 0
+        try:
+            value = fn(*args)
+            return self.lines, value
+        finally:
+            self.lines, self.indent = lines, indent
+
+    def replay(self, lines):
+        for indent, code, line in lines:
+            self.lines.append([indent + self.indent, code, line])
+
+    def isbuiltin(self, ast):
+        return ast.tag == IDENTIFIER and ast.scope is None and ast.value in compiled_builtins
+
+    def single(self, ast):
+        """只需要一个值的地方取第一个值"""
+        value = self.expr(ast)
+        return f'first({value})' if multivalued(ast) else value
+
+    def exprs(self, nodes, single=False):
+        """
+        按顺序转换多个表达式。后面的表达式输出了语句时，
+        前面已经转换的表达式先求值保存到临时变量，保持求值顺序。
+        """
+        values = []
+        marks = []
+        for node in nodes:
+            marks.append(len(self.lines))
+            values.append(self.single(node) if single else self.expr(node))
+        marks.append(len(self.lines))
+        last = max((i for i in range(len(nodes)) if marks[i+1] > marks[i]), default=0)
+        for i in range(last-1, -1, -1):
+            if not stable_expr.fullmatch(values[i]):
+                t = self.temp()
+                indent = self.indent
+                line = self.lines[marks[i+1]-1][2] if marks[i+1] else self.line
+                self.lines.insert(marks[i+1], [indent, f'{t} = {values[i]}', line])
+                values[i] = t
+        return values
+
+    def stmt(self, ast):
+        """值不需要的表达式，只在有副作用时输出"""
+        value = self.expr(ast)
+        if not stable_expr.fullmatch(value) and not variable_expr.fullmatch(value):
+            self.emit(value)
+
+    def body(self, items):
+        for item in items[:-1]:
+            self.stmt(item)
+        return self.expr(items[-1]) if items else 'None'
+
+    def expr(self, ast):
+        # 输出的代码行对应最近转换的fry节点所在的行
+        if ast.pos is not None:
+            self.line = self.lineof(ast.pos)
+        return self.convert(ast)
+
+    def convert(self, ast):
+        tag = ast.tag
+        if tag == NONE:
+            return 'None'
+        elif tag == TRUE:
+            return 'True'
+        elif tag == FALSE:
+            return 'False'
+        elif tag in (INTEGER, FLOAT):
+            if ast.value != ast.value or ast.value in (float('inf'), float('-inf')):
+                return self.const(ast.value)
+            return repr(ast.value)
+        elif tag in (SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING):
+            return repr(ast.value)
+        elif tag == INTERN_STRING:
+            return self.const(intern_string(ast.value))
+        elif tag == VARARG:
+            return self.var('...', ast.scope)
+        elif tag == IDENTIFIER:
+            if ast.scope is None:
+                return self.const(compiled_builtins[ast.value])
+            return self.var(ast.value, ast.scope)
+        elif tag == MULTI_IDENTIFIER:
+            return f'getpath({self.const(ast)}, {self.expr(ast.head)}, {self.const(ast.path)})'
+        elif tag in (AND_REMINDER, AT_WHOLE):
+            return 'None'
+        elif tag == COND_LIST:
+            return self.cond(ast)
+        elif tag == CODE_LIST:
+            return self.code(ast)
+        elif tag == HASH_LIST:
+            return self.hashfn(ast)
+        elif tag == LIST_LIST:
+            values = self.exprs(ast.value)
+            items = ', '.join(values)
+            if any(multivalued(item) for item in ast.value):
+                return f'List(splat([{items}]))'
+            return f'List([{items}])'
+        elif tag == DICT_LIST:
+            if ast.shape is not None:
+                values = self.exprs([pair.value[1] for pair in ast.value], True)
+                return f"Record({self.const(ast.shape)}, [{', '.join(values)}])"
+            nodes = [node for pair in ast.value for node in pair.value]
+            values = self.exprs(nodes, True)
+            for i in range(0, len(values), 2):
+                # 1.0、true等key要包装，见TaggedKey
+                if nodes[i].tag not in (INTEGER, SINGLE_STRING, DOUBLE_STRING, BACKTICK_STRING, INTERN_STRING):
+                    values[i] = f'dict_key({values[i]})'
+            items = ', '.join(f'{values[i]}: {values[i+1]}' for i in range(0, len(values), 2))
+            return f'Dict({{{items}}})'
+        raise RuntimeError(f"invalid ast: {ast}")
+
+    def code(self, ast):
+        if not ast.value:
+            raise RuntimeError("Invalid empty code list")
+        op = ast.value[0]
+        if op.tag == IDENTIFIER and op.value in code_list_parsers:
+            form = self.forms.get(op.value)
+            if not form:
+                raise Untranspilable(f"transpile does not support {op.value}")
+            return form(ast)
+        args = ast.value[1:]
+        values = self.exprs(ast.value)
+        fn, args = values[0], values[1:]
+        multi = any(multivalued(arg) for arg in ast.value[1:])
+        if self.isbuiltin(op):
+            if len(args) == 2 and not multi and op.value in binary_builtins:
+                return f'{self.const(binary_builtins[op.value])}({args[0]}, {args[1]})'
+            fn = self.const(compiled_builtins[op.value].value)
+            args = f"splat([{', '.join(args)}])" if multi else f"[{', '.join(args)}]"
+            return f'{fn}({args})'
+        args = f"splat([{', '.join(args)}])" if multi else f"[{', '.join(args)}]"
+        return f'call_value({fn}, {args})'
+
+    def code_do(self, ast):
+        return self.body(ast.value[1:])
+
+    def code_if(self, ast):
+        return self.branches([ast], None)
+
+    def cond(self, ast):
+        first = ast.value[0]
+        if first.special in (WHILE_LIST, FOR_LIST, EACH_LIST):
+            return self.loop(first, ast.value[1])
+        other = ast.value[-1] if ast.value[-1].special == ELSE_LIST else None
+        branches = ast.value[:-1] if other else ast.value
+        return self.branches(branches, other)
+
+    def branches(self, branches, other):
+        """if/elif/else链，谓词需要语句时放到上一个分支的else中"""
+        result = self.temp()
+        self.emit(f'{result} = None')
+        depth = 0
+        for i, branch in enumerate(branches):
+            lines, pred = self.capture(self.test, branch.value[1])
+            if i == 0 or lines:
+                if i > 0:
+                    self.emit('else:')
+                    self.indent += 1
+                    depth += 1
+                self.replay(lines)
+                self.emit(f'if {pred}:')
+            else:
+                self.emit(f'elif {pred}:')
+            self.indent += 1
+            self.emit(f'{result} = {self.body(branch.value[2:])}')
+            self.indent -= 1
+        if other:
+            self.emit('else:')
+            self.indent += 1
+            self.emit(f'{result} = {self.body(other.value[1:])}')
+            self.indent -= 1
+        self.indent -= depth
+        return result
+
+    def test(self, ast):
+        """谓词的Python表达式，用在if/while中，and/or/not短路求值"""
+        special = ast.special if ast.tag == CODE_LIST else None
+        if special == NOT_LIST:
+            return f'(not {self.test(ast.value[1])})'
+        if special not in (AND_LIST, OR_LIST):
+            return self.expr(ast)
+        parts = [self.capture(self.test, item) for item in ast.value[1:]]
+        op = ' and ' if special == AND_LIST else ' or '
+        if not any(lines for lines, _ in parts):
+            return '(' + op.join(value for _, value in parts) + ')'
+        # 操作数需要语句时展开为嵌套的if
+        result = self.temp()
+        self.emit(f"{result} = {special == OR_LIST}")
+        depth = self.indent
+        for lines, value in parts:
+            self.replay(lines)
+            if special == AND_LIST:
+                self.emit(f'if {value}:')
+            else:
+                self.emit(f'if not {value}:')
+            self.indent += 1
+        self.emit(f"{result} = {special == AND_LIST}")
+        self.indent = depth
+        return result
+
+    def code_bool(self, ast):
+        value = self.test(ast)
+        return value if ast.special == NOT_LIST else f'bool({value})'
+
+    def code_question(self, ast):
+        pred = self.test(ast.value[1])
+        (lines1, a), (lines2, b) = self.capture(self.expr, ast.value[2]), self.capture(self.expr, ast.value[3])
+        if not lines1 and not lines2:
+            return f'({a} if {pred} else {b})'
+        result = self.temp()
+        self.emit(f'if {pred}:')
+        self.indent += 1
+        self.replay(lines1)
+        self.emit(f'{result} = {a}')
+        self.indent -= 1
+        self.emit('else:')
+        self.indent += 1
+        self.replay(lines2)
+        self.emit(f'{result} = {b}')
+        self.indent -= 1
+        return result
+
+    def code_loop(self, ast):
+        return self.loop(ast, None)
+
+    def loop(self, ast, other):
+        """while/for/each，other是循环没有被break时执行的else"""
+        pred = ast.value[1]
+        flag = None
+        if ast.special == WHILE_LIST:
+            lines, value = self.capture(self.test, pred)
+            if not lines:
+                self.emit(f'while {value}:')
+                self.indent += 1
+                self.newcells(ast)
+            else:
+                # 谓词需要语句时，循环条件不满足用break跳出，用标志变量区分(break)
+                if other:
+                    flag = self.temp()
+                    self.emit(f'{flag} = False')
+                self.emit('while True:')
+                self.indent += 1
+                self.newcells(ast)
+                self.replay(lines)
+                self.emit(f'if not {value}:')
+                self.emit('    break')
+        elif ast.special == FOR_LIST:
+            bounds = self.exprs(pred.value[1:], True)
+            name = pred.value[0].value
+            if self.iscell(ast):
+                n = self.temp()
+                self.emit(f"for {n} in for_range({', '.join(bounds)}):")
+                self.indent += 1
+                self.newcells(ast)
+                self.emit(f'{self.var(name, ast)} = {n}')
+            else:
+                self.emit(f"for {self.var(name, ast)} in for_range({', '.join(bounds)}):")
+                self.indent += 1
+                self.newcells(ast)
+        else:
+            targets = pred.value[:-1]
+            if len(targets) > 2:
+                raise RuntimeError(f"Too many each bindings: {pred}")
+            seq = self.single(pred.value[-1])
+            names = [self.temp() for _ in targets]
+            self.emit(f"for {', '.join(names)} in each_items({seq}, {len(targets)}):")
+            self.indent += 1
+            self.newcells(ast)
+            for target, name in zip(targets, names):
+                self.bind(target, name)
+        self.loops.append(flag)
+        for item in ast.value[2:]:
+            self.stmt(item)
+        self.loops.pop()
+        self.emit('pass')
+        self.indent -= 1
+        if other:
+            if flag:
+                self.emit(f'if not {flag}:')
+            else:
+                self.emit('else:')
+            self.indent += 1
+            for item in other.value[1:]:
+                self.stmt(item)
+            self.emit('pass')
+            self.indent -= 1
+        return 'None'
+
+    def code_break(self, ast):
+        if not self.loops:
+            raise Untranspilable("transpile does not support break outside of loop body")
+        if self.loops[-1]:
+            self.emit(f'{self.loops[-1]} = True')
+        self.emit('break')
+        return 'None'
+
+    def code_continue(self, ast):
+        if not self.loops:
+            raise Untranspilable("transpile does not support continue outside of loop body")
+        self.emit('continue')
+        return 'None'
+
+    def function(self, ast, argv, nfixed, items):
+        """输出def，返回函数名"""
+        self.nfn += 1
+        name = f'_f{self.nfn}'
+        cells = sorted(self.pyname(var, scope) for var, scope in (ast.upvars or {}).items()
+                       if self.iscell(scope))
+        self.emit(f"def {name}(args{''.join(f', {cell}={cell}' for cell in cells)}):")
+        self.indent += 1
+        self.defs.append([ast, set(), len(self.lines)])
+        loops, self.loops = self.loops, []
+        fn = self.const(ast)
+        if nfixed is None:
+            self.emit(f'if len(args) != {len(argv)}: mismatch({fn}, args)')
+            params = [self.var(arg, ast) for arg in argv]
+        else:
+            self.emit(f'if len(args) < {nfixed}: tooless({fn}, args)')
+            params = [self.var(arg, ast) for arg in argv[:nfixed]]
+            self.emit(f"{self.var('...', ast)} = Values(args[{nfixed}:])")
+        if len(params) == 1:
+            self.emit(f'{params[0]} = args[0]')
+        elif params:
+            self.emit(f"{', '.join(params)} = args" + ('' if nfixed is None else f'[:{nfixed}]'))
+        self.emit(f'return {self.body(items)}')
+        _, nonlocals, start = self.defs.pop()
+        if nonlocals:
+            self.lines.insert(start, [self.indent, f"nonlocal {', '.join(sorted(nonlocals))}", self.line])
+        self.loops = loops
+        self.indent -= 1
+        return name
+
+    def code_fn(self, ast):
+        named = ast.value[1].tag == IDENTIFIER
+        body = ast.value[3:] if named else ast.value[2:]
+        name = self.function(ast, ast.argv, ast.nfixed, body)
+        if named:
+            return self.assign(ast.value[1].value, ast.getscope(), f'PyFunction({name}, True)')
+        return self.stable(f'PyFunction({name}, True)')
+
+    def hashfn(self, ast):
+        name = self.function(ast, ast.argv, None, [ast.value[0]])
+        return self.stable(f'PyFunction({name}, True)')
+
+    def code_let(self, ast):
+        """let/var：多个绑定对应(values ...)的多个值"""
+        targets = ast.value[1:-1]
+        node = ast.value[-1]
+        value = self.stable(self.expr(node))
+        if len(targets) == 1 and not multivalued(node):
+            self.bind(targets[0], value)
+            return value
+        values = self.temp()
+        self.emit(f'{values} = values_of({value}, {len(targets)}, {self.const(ast)})')
+        for i, target in enumerate(targets):
+            self.bind(target, f'{values}[{i}]')
+        return f'{values}[0]'
+
+    def bind(self, target, value):
+        """按照parse_destructure处理过的模式绑定变量"""
+        if target.tag == IDENTIFIER:
+            if target.value != '_':
+                self.assign(target.value, target.getscope(), value)
+        elif target.tag == VARARG:
+            self.assign('...', target.getscope(), value)
+        elif target.tag == LIST_LIST:
+            value = self.stable(value)
+            n = max((i+1 for i, item in enumerate(target.value)
+                     if item.tag not in (AND_REMINDER, AT_WHOLE)), default=0)
+            items = self.temp()
+            self.emit(f'{items} = list_items({value}, {n}, {self.const(target)})')
+            for i, item in enumerate(target.value):
+                if item.tag == AND_REMINDER:
+                    self.assign(item.value, item.getscope(), f'List({items}[{i}:])')
+                elif item.tag == AT_WHOLE:
+                    self.assign(item.value, item.getscope(), value)
+                else:
+                    self.bind(item, f'{items}[{i}]')
+        elif target.tag == DICT_LIST:
+            value = self.stable(value)
+            pattern = self.const(target)
+            self.emit(f'dict_check({value}, {pattern})')
+            keys = []
+            for pair in target.value:
+                key, item = pair.value
+                if item.tag == AT_WHOLE:
+                    self.assign(item.value, item.getscope(), value)
+                elif item.tag != AND_REMINDER:
+                    k = self.stable(self.single(key))
+                    keys.append(k)
+                    self.bind(item, f'dict_get({value}, {k}, {pattern})')
+            for pair in target.value:
+                item = pair.value[1]
+                if item.tag == AND_REMINDER:
+                    self.assign(item.value, item.getscope(), f"dict_rest({value}, ({''.join(k + ', ' for k in keys)}))")
+        else:
+            raise RuntimeError(f"invalid destructure: {target}")
+
+    def code_set(self, ast):
+        target = ast.value[1]
+        if target.tag != IDENTIFIER:
+            raise RuntimeError(f"Invalid set target {target}")
+        return self.assign(target.value, target.scope, self.single(ast.value[2]))
+
+    def code_pass(self, ast):
+        for item in ast.value[1:]:
+            self.stmt(item)
+        return 'None'
+
+    def code_dot(self, ast):
+        if ast.path is not None:
+            value = self.single(ast.value[1])
+            return f'getpath({self.const(ast)}, {value}, {self.const(ast.path)})'
+        values = self.exprs(ast.value[1:], True)
+        return f"getpath(None, {values[0]}, [{', '.join(values[1:])}])"
+
+
+class Program:
+    """
+    转换为Python代码并编译好的fry程序。
+    source是生成的Python代码，linemap[i]是Python第i+1行对应的fry行号，
+    report是转换前各个优化pass删除的节点数。
+    """
+    def __init__(self, code, filename='<fry>', passes=()):
+        if isinstance(code, str):
+            newlines = [m.start() for m in re.finditer('\n', code)]
+        else:
+            newlines = [m.start() for m in re.finditer(b'\n', code)]
+        lineof = lambda pos: bisect.bisect_left(newlines, pos) + 1
+        root = lex(code)
+        parse(root)
+        self.report = optimize(root, passes) if passes else {}
+        transpiler = Transpiler(lineof)
+        self.source, self.linemap = transpiler.transpile(root)
+        self.filename = filename
+        self.consts = transpiler.consts
+        self.code = compile(self.source, filename, 'exec')
+
+    def fry_lines(self, tb):
+        """traceback中属于本程序的各层对应的fry行号"""
+        lines = []
+        while tb:
+            if tb.tb_frame.f_code.co_filename == self.filename and self.linemap[tb.tb_lineno - 1]:
+                lines.append(self.linemap[tb.tb_lineno - 1])
+            tb = tb.tb_next
+        return lines
+
+    def run(self):
+        env = dict(transpile_runtime)
+        env.update(self.consts)
+        exec(self.code, env)
+        try:
+            return env['__fry__']()
+        except Exception as e:
+            lines = self.fry_lines(e.__traceback__)
+            if lines and hasattr(e, 'add_note'):
+                e.add_note(f"fry traceback: {' -> '.join(f'line {n}' for n in lines)}")
+            raise
+
+
+# 最多缓存的Program个数
+programs_max = 64
+
+# (源代码, filename, passes) -> Program，最近最少使用的先淘汰；不能转换的源代码缓存Untranspilable
+programs = collections.OrderedDict()
+
+def transpile(code, filename='<fry>', passes=()):
+    """
+    转换为Python代码并编译，最近用过的源代码不重复转换。
+    有不支持的表达式时抛出Untranspilable。
+    """
+    key = (code if isinstance(code, (str, bytes)) else bytes(code), filename, tuple(passes))
+    program = programs.get(key)
+    if program is None:
+        try:
+            program = Program(code, filename, passes)
+        except Untranspilable as e:
+            program = e
+        programs[key] = program
+        if len(programs) > programs_max:
+            programs.popitem(last=False)
+    else:
+        programs.move_to_end(key)
+    if program.__class__ is Untranspilable:
+        raise program.with_traceback(None)
+    return program
+
+def run(code, filename='<fry>', passes=()):
+    """
+    和interpret相同，但是转换为Python代码执行。
+    match/case、import等transpile不支持的表达式所在的程序整个用interpret执行。
+    """
+    try:
+        program = transpile(code, filename, passes)
+    except Untranspilable:
+        return interpret(code, passes)
+    return program.run()
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv) != 2:
         print(f"usage: {sys.argv[0]} <.fry file>")
         sys.exit(1)
-    with open(sys.argv[1], encoding='utf-8') as f:
-        data = f.read()
-    ast = lex(data)
+    ast = lexfile(sys.argv[1])
     parse(ast)
     print()
     print(f"========== {sys.argv[1]} ==========")
-    print(data)
+    # 逐行输出源文件，不把整个文件读成str
+    with open(sys.argv[1], encoding='utf-8') as f:
+        for line in f:
+            sys.stdout.write(line)
+    print()
     print("-----------------------")
     print(ast)
     print()
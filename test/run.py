@@ -0,0 +1,226 @@
+"""
+运行test/中的fry程序：
+    python test/run.py [n]            regress_*.fry在各种执行方式下输出相同并且没有fail，
+                                      再对它们做n次(默认1000)随机修改，比较reparse和整个重新parse的结果
+    python test/run.py bench [名字]   bench_*.fry在各种执行方式下的时间和extras中的对比，
+                                      给出名字(如bench_loop、serialize)时只运行这些
+"""
+import contextlib
+import glob
+import io
+import json
+import os
+import pickle
+import random
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import fry
+
+# 多个worker时pmap/peach才会用到线程池和进程池
+fry.pmap_workers = 4
+
+
+def programs(prefix):
+    for path in sorted(glob.glob(os.path.join(here, prefix + '*.fry'))):
+        with open(path, encoding='utf-8') as f:
+            yield os.path.basename(path), f.read()
+
+
+def scheduled(code, budget):
+    scheduler = fry.Scheduler(budget)
+    task = scheduler.spawn(code)
+    scheduler.run()
+    if task.error:
+        raise task.error
+    return task.result
+
+
+modes = {
+    'interpret': lambda code: fry.interpret(code),
+    'optimize': lambda code: fry.interpret(code, fry.optimize_passes),
+    'lazy': lambda code: fry.interpret(code, lazy=True),
+    'scheduler': lambda code: scheduled(code, 3),
+    'transpile': lambda code: fry.run(code),
+    'transpile-optimize': lambda code: fry.run(code, passes=fry.optimize_passes),
+}
+
+# bench计时的执行方式
+bench_modes = [mode for mode in ('interpret', 'optimize', 'transpile') if mode in modes]
+
+
+def output(run, code):
+    """执行code，返回输出和结果(或者异常)"""
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            result = fry.display(run(code), True)
+    except Exception as e:
+        result = f'{type(e).__name__}: {e}'
+    return out.getvalue() + result
+
+
+def regress():
+    failed = 0
+    for name, code in programs('regress_'):
+        expected = output(modes['interpret'], code)
+        if 'fail' in expected:
+            print(f'{name}: interpret\n{expected}')
+            failed += 1
+        for mode, run in modes.items():
+            got = output(run, code)
+            if got != expected:
+                print(f'{name}: {mode}\n{got}\n---- interpret\n{expected}')
+                failed += 1
+    return failed
+
+
+def full_parse(code):
+    # lex和parse出错时会输出出错的节点
+    with contextlib.redirect_stdout(io.StringIO()):
+        root = fry.lex(code)
+        fry.parse(root)
+    return root
+
+
+def node_id(ast):
+    if ast is None:
+        return None
+    pos = fry.toplevel_pos(ast) if ast.tag == fry.COND_LIST else ast.pos
+    return ast.tag, pos
+
+
+def signature(root):
+    """比较两棵树用的节点内容、位置和作用域分析结果"""
+    nodes = []
+    for ast in fry.walk(root):
+        nodes.append((ast.tag, len(ast.value) if isinstance(ast.value, list) else ast.value,
+                      ast.suffix, ast.pos, ast.special, node_id(ast.scope), node_id(ast.parent),
+                      sorted(ast.boundvars) if ast.boundvars else None,
+                      sorted(ast.upvars) if ast.upvars else None))
+    return nodes
+
+
+edits = ['1', '(', ')', 'x', ' ', '\n', '(let z 3)\n', '(print z)\n', '(elif true: 1)\n',
+         'n', '`t\n', '#', '"', ';']
+
+
+def reparse(count, seed=1):
+    """
+    随机修改regress_*.fry，每次修改后reparse的树和整个重新parse的相同，
+    shadowing/captured不少于重新parse的结果；修改后有错误时两者都报错，树保持不变
+    """
+    rand = random.Random(seed)
+    sources = [code for _, code in programs('regress_')]
+    failed = done = 0
+    while done < count:
+        code = rand.choice(sources)
+        root = full_parse(code)
+        for _ in range(5):
+            offset = rand.randrange(len(code) + 1)
+            deleted = min(rand.choice([0, 0, 1, 2, 5]), len(code) - offset)
+            inserted = rand.choice(edits) if rand.random() < 0.8 else ''
+            new = code[:offset] + inserted + code[offset+deleted:]
+            done += 1
+            before = signature(root)
+            try:
+                expected = full_parse(new)
+            except Exception:
+                expected = None
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fry.reparse(root, code, offset, deleted, inserted)
+            except Exception:
+                if expected is not None or signature(root) != before:
+                    print('reparse error', repr(code), offset, deleted, repr(inserted))
+                    failed += 1
+                break
+            if expected is None or signature(root) != signature(expected) or any(
+                    (b.shadowing and not a.shadowing) or (b.captured and not a.captured)
+                    for a, b in zip(fry.walk(root), fry.walk(expected))):
+                print('reparse mismatch', repr(code), offset, deleted, repr(inserted))
+                failed += 1
+                break
+            code = new
+    print(f'reparse: {count} edits')
+    return failed
+
+
+def timed(f, *args):
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        f(*args)
+    return time.perf_counter() - begin
+
+
+def bench_serialize():
+    """和JSON、pickle以及fry文本比较"""
+    text = '[' + ' '.join(f'{{id: {i}, name: "item{i}", tags: [:a :b], score: {i / 4}}}'
+                          for i in range(20000)) + ']'
+    levels = ['info', 'warn', 'error']
+    workloads = [
+        # name各不相同，只有key和:keyword重复
+        ('records', fry.loads(text), text),
+        # 少数几种字符串值反复出现，但各是不同的str对象
+        ('events', [{'level': levels[i % 3], 'host': f'web-{i % 8}', 'path': f'/api/items/{i % 50}',
+                     'status': 200, 'ms': i % 97} for i in range(20000)], None),
+        # 同一个list被引用多次
+        ('shared', [[{'x': i, 'y': i * 2} for i in range(20)]] * 5000, None),
+    ]
+    for workload, value, source in workloads:
+        print(workload)
+        cases = [
+            ('fry binary', fry.serialize, lambda data: fry.deserialize(data, True)),
+            ('json', json.dumps, json.loads),
+            ('pickle', pickle.dumps, pickle.loads),
+        ]
+        for name, dump, load in cases:
+            data = dump(value)
+            print(f'  {name:12}{len(data):>10} bytes  dump {timed(dump, value):.3f}s  load {timed(load, data):.3f}s')
+        if source is not None:
+            print(f'  {"fry text":12}{len(source.encode()):>10} bytes  dump     -   load {timed(fry.loads, source):.3f}s')
+
+
+def bench_scheduler():
+    """多个程序由Scheduler轮流执行和依次执行"""
+    code = '(fn fib [n]: (? (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))) (fib 12)'
+    count = 200
+    serial = timed(lambda: [fry.interpret(code) for _ in range(count)])
+    scheduler = fry.Scheduler()
+    for _ in range(count):
+        scheduler.spawn(code)
+    print(f'{count} programs: serial {serial:.2f}s, scheduler {timed(scheduler.run):.2f}s')
+
+
+# 用Python写的对比
+extras = {
+    'serialize': bench_serialize,
+    'scheduler': bench_scheduler,
+}
+
+
+def bench(names):
+    print(f'{"":24}' + ''.join(f'{mode:>12}' for mode in bench_modes))
+    for name, code in programs('bench_'):
+        if names and name[:-4] not in names:
+            continue
+        times = [timed(modes[mode], code) for mode in bench_modes]
+        print(f'{name:24}' + ''.join(f'{t:11.2f}s' for t in times))
+        if '(pmap ' in code:
+            serial = timed(modes['interpret'], code.replace('(pmap ', '(map '))
+            print(f'{"  with map":24}{serial:11.2f}s   ({os.cpu_count()} cpus)')
+    for name, f in extras.items():
+        if not names or name in names:
+            f()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench']:
+        bench(sys.argv[2:])
+    else:
+        failed = regress()
+        failed += reparse(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
+        print('failed' if failed else 'ok')
+        sys.exit(1 if failed else 0)